@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import shutil
+import random
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+import logging
+
+from util.environment import Environment
+from util.fakes import FakeGIS, FakeItem, FakeFeatureLayer, FakeS3Client, FakeBoto3, RequestStats
+from util.transfer import DEFAULT_WORKERS, DEFAULT_LAYER_WORKERS
+from util.metrics import RunMetrics
+from util import clients
+from util.clients import DEFAULT_MAX_RATE
+
+import trap_config
+import trapper_data_modification
+import trapper_reporting
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_ATTACHMENT_SIZE = 4 * 1024
+
+# synthetic data starts on 2024-01-01 and adds a record every few hours
+START_MS = 1704067200000
+STEP_MS = 4 * 60 * 60 * 1000
+
+TRAPS_FIELDS = {'OBJECTID': 'esriFieldTypeOID', 'GlobalID': 'esriFieldTypeGlobalID',
+                'SET_UNIQUE_ID': 'esriFieldTypeString', 'MESO_GRID_ID': 'esriFieldTypeString',
+                'INCLUDE_COORDINATES': 'esriFieldTypeString', 'TRAP_STATUS': 'esriFieldTypeString',
+                'TRAPSET_TYPES': 'esriFieldTypeString', 'START_DATE': 'esriFieldTypeDate',
+                'PICTURE': 'esriFieldTypeString', 'EDIT_DATE': 'esriFieldTypeDate',
+                'CALCULATE_DATE': 'esriFieldTypeDate'}
+TRAP_CHECK_FIELDS = {'OBJECTID': 'esriFieldTypeOID', 'GlobalID': 'esriFieldTypeGlobalID',
+                     'SET_UNIQUE_ID': 'esriFieldTypeString', 'TRAP_CHECK_NUMBER': 'esriFieldTypeInteger',
+                     'TRAP_STATUS': 'esriFieldTypeString', 'CHECK_DATE': 'esriFieldTypeDate',
+                     'PICTURE': 'esriFieldTypeString', 'EDIT_DATE': 'esriFieldTypeDate',
+                     'CALCULATE_DATE': 'esriFieldTypeDate'}
+FISHER_FIELDS = {'OBJECTID': 'esriFieldTypeOID', 'GlobalID': 'esriFieldTypeGlobalID',
+                 'OBSERVATION_TYPE': 'esriFieldTypeString', 'OBSERVATION_DATE': 'esriFieldTypeDate',
+                 'PICTURE': 'esriFieldTypeString', 'EDIT_DATE': 'esriFieldTypeDate',
+                 'CALCULATE_DATE': 'esriFieldTypeDate'}
+MESO_GRID_FIELDS = {'OBJECTID': 'esriFieldTypeOID', 'MesoCell': 'esriFieldTypeString',
+                    'CENTROID_X': 'esriFieldTypeDouble', 'CENTROID_Y': 'esriFieldTypeDouble'}
+
+
+def run_app():
+    sizes, attachment_size, passes, workers, layer_workers, stream, throttle_every, trace_memory, output, logger = \
+        get_input_parameters()
+
+    lst_results = []
+    if trace_memory:
+        tracemalloc.start()
+    for size in sizes:
+        benchmark = Benchmark(size=size, attachment_size=attachment_size, workers=workers,
+                              layer_workers=layer_workers, stream=stream, throttle_every=throttle_every,
+                              trace_memory=trace_memory, logger=logger)
+        lst_results.extend(benchmark.run(passes=passes))
+        del benchmark
+
+    print_results(lst_results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(lst_results, f, indent=2)
+        logger.info(f'Wrote benchmark results to {output}')
+
+
+def get_input_parameters():
+    """
+    Function:
+        Sets up parameters and the logger object
+    Returns:
+        tuple: user entered parameters required for tool execution
+    """
+    try:
+        parser = ArgumentParser(description='This script benchmarks the trapper data scripts against in-process fakes of ArcGIS Online and object storage')
+        parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                            help='Number of traps to generate for each benchmark run')
+        parser.add_argument('--attachment_size', type=int, default=DEFAULT_ATTACHMENT_SIZE,
+                            help='Size in bytes of each synthetic attachment')
+        parser.add_argument('--passes', type=int, default=2,
+                            help='Runs of each job per size, the first is cold and the rest are incremental')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of attachments transferred concurrently')
+        parser.add_argument('--layer_workers', type=int, default=DEFAULT_LAYER_WORKERS,
+                            help='Number of layers processed concurrently')
+        parser.add_argument('--transfer_mode', default='stream', choices=['stream', 'download'],
+                            help='Transfer mode used by the reporting job')
+        parser.add_argument('--throttle_every', type=int, default=0,
+                            help='Answer every nth attachment stream with a 429 to exercise the rate limiter, 0 never does')
+        parser.add_argument('--skip_memory', action='store_true',
+                            help='Do not trace peak memory, tracing slows every stage down')
+        parser.add_argument('--output', help='Path of a json file to write the results to')
+        parser.add_argument('--log_level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                            help='Log level')
+        parser.add_argument('--log_dir', help='Path to log directory')
+
+        args = parser.parse_args()
+        logger = Environment.setup_logger(args)
+
+        return args.sizes, args.attachment_size, args.passes, args.workers, args.layer_workers, \
+            args.transfer_mode == 'stream', args.throttle_every, not args.skip_memory, args.output, logger
+
+    except Exception as e:
+        logging.error('Unexpected exception. Program terminating: {}'.format(e))
+        raise Exception('Errors exist')
+
+
+def print_results(lst_results) -> None:
+    print(f'{"size":>8} {"pass":>4} {"job":<13} {"stage":<22} {"wall_s":>8} {"requests":>9} '
+          f'{"mb_down":>9} {"mb_up":>9} {"peak_mb":>9}')
+    for r in lst_results:
+        peak = f'{r["peak_mb"]:9.1f}' if r['peak_mb'] is not None else f'{"-":>9}'
+        print(f'{r["size"]:>8} {r["pass"]:>4} {r["job"]:<13} {r["stage"]:<22} {r["wall_s"]:8.2f} '
+              f'{r["requests"]:>9} {r["bytes_down"] / 1e6:9.2f} {r["bytes_up"] / 1e6:9.2f} {peak}')
+
+
+class Benchmark:
+    def __init__(self, size, attachment_size, workers, layer_workers, stream, throttle_every, trace_memory,
+                 logger) -> None:
+        self.size = size
+        self.attachment_size = attachment_size
+        self.workers = workers
+        self.layer_workers = layer_workers
+        self.stream = stream
+        self.trace_memory = trace_memory
+        self.logger = logger
+
+        self.work_dir = tempfile.mkdtemp(prefix=f'trapper_benchmark_{size}_')
+        self.stats = RequestStats()
+        self.gis = FakeGIS(stats=self.stats, throttle_every=throttle_every)
+        self.s3_client = FakeS3Client(root_dir=os.path.join(self.work_dir, 'object_storage'), stats=self.stats)
+        self.lst_results = []
+
+    def __del__(self) -> None:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run(self, passes) -> list:
+        """
+        Function:
+            Generates the synthetic dataset and runs the modification and reporting jobs against the fakes, stage by stage
+        Returns:
+            list: one result dict per stage
+        """
+        self.logger.warning(f'Generating synthetic data for {self.size} traps')
+        self.generate_data()
+
+        clients.connect_gis = lambda **kwargs: self.gis
+        trapper_reporting.create_s3_resource = lambda **kwargs: FakeBoto3(self.s3_client).resource()
+
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            for run_pass in range(1, passes + 1):
+                self.logger.warning(f'Benchmarking {self.size} traps, pass {run_pass}')
+                # each job watches the session with its own run metrics, drop the hooks left by the previous ones
+                self.gis._con._session.hooks['response'].clear()
+                traps = trapper_data_modification.Traps(ago_user=None, ago_pass=None,
+                                                        cache_dir=os.path.join(self.work_dir, 'cache'),
+                                                        workers=self.workers, layer_workers=self.layer_workers,
+                                                        max_rate=DEFAULT_MAX_RATE, full=False, s3_client=self.s3_client,
+                                                        metrics=RunMetrics(job='benchmark', logger=self.logger),
+                                                        logger=self.logger)
+                self.measure(run_pass, 'modification', 'check', traps.has_changes)
+                self.measure(run_pass, 'modification', 'recover', traps.recover)
+                self.measure(run_pass, 'modification', 'shift_traps', traps.shift_traps)
+                self.measure(run_pass, 'modification', 'update_trap_status', traps.update_trap_status)
+                self.measure(run_pass, 'modification', 'update_attachments', traps.update_attachments)
+                self.measure(run_pass, 'modification', 'save_state',
+                             lambda: traps.watermarks.save() or traps.attachment_cache.save() or traps.journal.clear())
+                del traps
+
+                self.gis._con._session.hooks['response'].clear()
+                report = trapper_reporting.TrapReport(ago_user=None, ago_pass=None, obj_store_user=None,
+                                                      obj_store_secret=None, obj_store_host=None,
+                                                      cache_dir=os.path.join(self.work_dir, 'cache'),
+                                                      workers=self.workers, layer_workers=self.layer_workers,
+                                                      max_rate=DEFAULT_MAX_RATE, stream=self.stream, full=False,
+                                                      metrics=RunMetrics(job='benchmark', logger=self.logger),
+                                                      logger=self.logger)
+                self.measure(run_pass, 'reporting', 'check', report.has_changes)
+                self.measure(run_pass, 'reporting', 'download_attachments', report.download_attachments)
+                self.measure(run_pass, 'reporting', 'create_excel', report.create_excel)
+                self.measure(run_pass, 'reporting', 'export_parquet', report.export_parquet)
+                self.measure(run_pass, 'reporting', 'save_state',
+                             lambda: report.watermarks.save() or report.journal.clear())
+                del report
+        finally:
+            os.chdir(cwd)
+
+        return self.lst_results
+
+    def measure(self, run_pass, job, stage, func) -> None:
+        """
+        Function:
+            Runs one stage and records its wall time, requests, bytes moved and peak traced memory
+        Returns:
+            None
+        """
+        stats_before = self.stats.snapshot()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        func()
+        wall = time.perf_counter() - start
+        peak_mb = (tracemalloc.get_traced_memory()[1] - memory_before) / 1e6 if self.trace_memory else None
+        stats_after = self.stats.snapshot()
+
+        dict_requests = {op: count - stats_before['requests'].get(op, 0)
+                         for op, count in stats_after['requests'].items()
+                         if count - stats_before['requests'].get(op, 0)}
+        self.lst_results.append({'size': self.size, 'pass': run_pass, 'job': job, 'stage': stage,
+                                 'wall_s': round(wall, 3), 'requests': sum(dict_requests.values()),
+                                 'requests_by_operation': dict_requests,
+                                 'bytes_down': stats_after['bytes_down'] - stats_before['bytes_down'],
+                                 'bytes_up': stats_after['bytes_up'] - stats_before['bytes_up'],
+                                 'peak_mb': round(peak_mb, 1) if peak_mb is not None else None})
+
+    def generate_data(self) -> None:
+        """
+        Function:
+            Builds the traps layer and trap check table, the fisher layer and the meso grid at the benchmark size. A fifth of
+            the traps hide their coordinates, every trap has two checks and every feature has one unrenamed photo.
+        Returns:
+            None
+        """
+        rand = random.Random(self.size)
+        cell_count = max(1, self.size // 10)
+
+        mesogrid_layer = self.make_layer('mesogrid', MESO_GRID_FIELDS, 'esriGeometryPolygon')
+        mesogrid_layer.add_records([{'OBJECTID': c + 1, 'MesoCell': f'G{c}', 'CENTROID_X': -122.0 + c % 100 * 0.01,
+                                     'CENTROID_Y': 52.0 + c // 100 * 0.01} for c in range(cell_count)])
+
+        traps_layer = self.make_layer('traps', TRAPS_FIELDS, 'esriGeometryPoint')
+        lst_traps = [{'OBJECTID': i + 1, 'GlobalID': f'{{trap-{i}}}', 'SET_UNIQUE_ID': f'TRAP{i}_2024',
+                      'MESO_GRID_ID': f'G{rand.randrange(cell_count)}',
+                      'INCLUDE_COORDINATES': 'NO' if i % 5 == 0 else 'YES', 'TRAP_STATUS': 'Active',
+                      'TRAPSET_TYPES': 'cubby', 'START_DATE': START_MS + i * STEP_MS,
+                      'PICTURE': f'IMG_T{i}.jpg', 'EDIT_DATE': START_MS + i * STEP_MS, 'CALCULATE_DATE': None}
+                     for i in range(self.size)]
+        traps_layer.add_records(lst_traps, [{'x': -122.5 + rand.random(), 'y': 52.5 + rand.random(),
+                                             'spatialReference': {'wkid': 4326}} for _ in lst_traps])
+
+        checks_table = self.make_layer('trap_checks', TRAP_CHECK_FIELDS)
+        lst_checks = [{'OBJECTID': i + 1, 'GlobalID': f'{{check-{i}}}', 'SET_UNIQUE_ID': f'TRAP{i % self.size}_2024',
+                       'TRAP_CHECK_NUMBER': i // self.size + 1,
+                       'TRAP_STATUS': rand.choice(['Active', 'Removed', 'Sprung']),
+                       'CHECK_DATE': START_MS + i * STEP_MS, 'PICTURE': f'IMG_C{i}.jpg',
+                       'EDIT_DATE': START_MS + i * STEP_MS, 'CALCULATE_DATE': None}
+                      for i in range(2 * self.size)]
+        checks_table.add_records(lst_checks)
+
+        fisher_layer = self.make_layer('fisher', FISHER_FIELDS, 'esriGeometryPoint')
+        lst_fisher = [{'OBJECTID': i + 1, 'GlobalID': f'{{fisher-{i}}}',
+                       'OBSERVATION_TYPE': rand.choice(['Track', 'Scat', 'Camera']),
+                       'OBSERVATION_DATE': START_MS + i * STEP_MS, 'PICTURE': f'IMG_F{i}.jpg',
+                       'EDIT_DATE': START_MS + i * STEP_MS, 'CALCULATE_DATE': None}
+                      for i in range(max(1, self.size // 10))]
+        fisher_layer.add_records(lst_fisher, [{'x': -122.5 + rand.random(), 'y': 52.5 + rand.random(),
+                                               'spatialReference': {'wkid': 4326}} for _ in lst_fisher])
+
+        for layer, lst_records in [(traps_layer, lst_traps), (checks_table, lst_checks), (fisher_layer, lst_fisher)]:
+            for record in lst_records:
+                layer.attachments.seed(oid=record['OBJECTID'], name=record['PICTURE'], size=self.attachment_size)
+
+        self.gis.add_item(FakeItem(trap_config.TRAPS, layers=[traps_layer], tables=[checks_table]))
+        self.gis.add_item(FakeItem(trap_config.FISHER, layers=[fisher_layer]))
+        self.gis.add_item(FakeItem(trap_config.MESO_GRID, layers=[mesogrid_layer]))
+
+    def make_layer(self, name, dict_fields, geometry_type=None) -> FakeFeatureLayer:
+        return FakeFeatureLayer(url=f'https://fake.arcgis.local/{name}/FeatureServer/0',
+                                fields=[{'name': field, 'type': field_type} for field, field_type in dict_fields.items()],
+                                stats=self.stats, geometry_type=geometry_type)
+
+
+if __name__ == '__main__':
+    run_app()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import their helpers as top level modules, e.g. `from util.fakes import FakeGIS`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,21 @@
+import logging
+
+from util.attachments import get_attachment_inventory
+from util.fakes import FakeFeatureLayer, RequestStats
+
+logger = logging.getLogger('test_attachments')
+
+
+def test_inventory_pages_past_the_record_limit():
+    layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0',
+                             fields=[{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}], stats=RequestStats(),
+                             max_record_count=4)
+    layer.add_records([{'OBJECTID': oid} for oid in range(1, 4)])
+    for oid in range(1, 4):
+        for photo in range(3):
+            layer.attachments.seed(oid=oid, name=f'{oid}_{photo}.jpg', size=10)
+
+    dict_attachments = get_attachment_inventory(ago_flayer=layer, lst_oids=[1, 2, 3], logger=logger)
+
+    assert {oid: len(lst) for oid, lst in dict_attachments.items()} == {1: 3, 2: 3, 3: 3}
+    assert [a['name'] for a in dict_attachments[3]] == ['3_0.jpg', '3_1.jpg', '3_2.jpg']
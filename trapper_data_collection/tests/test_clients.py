@@ -0,0 +1,50 @@
+import logging
+
+import pytest
+
+pytest.importorskip('requests')
+
+from util.attachments import open_attachment_stream
+from util.clients import AdaptiveRateLimiter, configure_gis_session
+from util.fakes import FakeGIS, FakeItem, FakeFeatureLayer
+from util.metrics import RunMetrics
+
+logger = logging.getLogger('test_clients')
+
+
+def make_gis(throttle_every=0):
+    gis = FakeGIS(throttle_every=throttle_every)
+    layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0',
+                             fields=[{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}], stats=gis.stats)
+    layer.add_records([{'OBJECTID': 1}])
+    layer.attachments.seed(oid=1, name='a.jpg', size=64)
+    gis.add_item(FakeItem('traps', layers=[layer]))
+    return gis, layer
+
+
+def test_throttled_stream_is_retried_through_the_rate_limiter():
+    gis, layer = make_gis(throttle_every=2)
+    rate_limiter = AdaptiveRateLimiter(logger=logger, max_rate=1000)
+    configure_gis_session(gis=gis, rate_limiter=rate_limiter, pool_size=1, logger=logger)
+
+    bodies = []
+    for _ in range(2):
+        with open_attachment_stream(gis=gis, ago_flayer=layer, oid=1, attach_id=1) as response:
+            bodies.append(response.raw.read())
+
+    assert bodies == [layer.attachments.get_body(1, 1)] * 2
+    assert rate_limiter.throttled == 1
+    assert gis.stats.snapshot()['requests'] == {'attachments.stream': 2, 'attachments.throttled': 1}
+
+
+def test_streams_are_counted_in_run_metrics():
+    gis, layer = make_gis()
+    metrics = RunMetrics(job='test', logger=logger)
+    metrics.watch_gis(gis)
+    with metrics.stage('copy'):
+        with open_attachment_stream(gis=gis, ago_flayer=layer, oid=1, attach_id=1) as response:
+            response.raw.read()
+
+    stage = metrics.to_dict()['stages']['copy']
+    assert stage['api_calls'] == {'agol.attachment': 1}
+    assert stage['bytes_down'] == 64
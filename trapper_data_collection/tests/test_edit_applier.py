@@ -0,0 +1,54 @@
+import logging
+
+from util.edit_applier import EditApplier
+
+logger = logging.getLogger('test_edit_applier')
+
+
+class RejectingLayer:
+    # fails every edit_features call with more than max_features updates with the given error
+    def __init__(self, error, max_features=0):
+        self.error = error
+        self.max_features = max_features
+        self.calls = 0
+
+    def edit_features(self, updates=None, **kwargs):
+        self.calls += 1
+        if len(updates) > self.max_features:
+            raise Exception(self.error)
+        return {'updateResults': [{'objectId': u['attributes']['OBJECTID'], 'success': True} for u in updates]}
+
+
+def make_applier():
+    applier = EditApplier(logger=logger, workers=1, chunk_size=8)
+    applier.retry_policy.backoff = 0
+    return applier
+
+
+def make_updates(count):
+    return [{'attributes': {'OBJECTID': oid}} for oid in range(1, count + 1)]
+
+
+def test_oversized_chunk_is_split():
+    layer = RejectingLayer(error='Error code 413: Request Entity Too Large', max_features=2)
+    summary = make_applier().apply(ago_flayer=layer, updates=make_updates(8), label='traps')
+
+    assert summary.all_succeeded
+    assert sorted(summary.lst_succeeded) == list(range(1, 9))
+
+
+def test_throttled_chunk_fails_whole_without_splitting():
+    layer = RejectingLayer(error='Error code 429: Too Many Requests')
+    applier = make_applier()
+    summary = applier.apply(ago_flayer=layer, updates=make_updates(8), label='traps')
+
+    assert layer.calls == applier.retry_policy.retries + 1
+    assert sorted(summary.dict_failed) == list(range(1, 9))
+
+
+def test_other_errors_fail_whole_chunk():
+    layer = RejectingLayer(error='Unable to complete operation')
+    summary = make_applier().apply(ago_flayer=layer, updates=make_updates(8), label='traps')
+
+    assert layer.calls == 1
+    assert sorted(summary.dict_failed) == list(range(1, 9))
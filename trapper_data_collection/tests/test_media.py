@@ -0,0 +1,66 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('requests')
+
+from util import clients, media
+from util.fakes import FakeGIS, FakeItem, FakeFeatureLayer, FakeS3Client
+from util.media import MediaSettings
+from util.metrics import RunMetrics
+
+import trap_config
+import trapper_data_modification
+
+logger = logging.getLogger('test_media')
+
+
+def fake_process_image(file_path, compressed_path, thumbnail_path, max_dimension, quality, thumbnail_size) -> bool:
+    # stands in for the PIL re-encode, halving the photo
+    with open(file_path, 'rb') as f:
+        body = f.read()
+    for path in [compressed_path, thumbnail_path]:
+        with open(path, 'wb') as f:
+            f.write(body[:len(body) // 2])
+    return True
+
+
+def test_compressed_photo_is_cached_once_and_original_archived(monkeypatch, tmp_path):
+    monkeypatch.setattr(media, 'process_image', fake_process_image)
+    monkeypatch.setattr(media.MediaProcessor, 'get_pool', lambda self: ThreadPoolExecutor(max_workers=1))
+
+    gis = FakeGIS()
+    fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'PICTURE', 'type': 'esriFieldTypeString'}]
+    traps_layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0', fields=fields,
+                                   stats=gis.stats)
+    traps_layer.add_records([{'OBJECTID': 1, 'SET_UNIQUE_ID': 'T1_2024', 'PICTURE': 'a.jpg'}])
+    traps_layer.attachments.seed(oid=1, name='a.jpg', size=1000)
+    original = traps_layer.attachments.get_body(1, 1)
+    gis.add_item(FakeItem(trap_config.TRAPS, layers=[traps_layer], tables=[]))
+    monkeypatch.setattr(clients, 'connect_gis', lambda **kwargs: gis)
+    s3_client = FakeS3Client(root_dir=str(tmp_path / 'object_storage'))
+
+    settings = MediaSettings(workers=1, max_dimension=2048, quality=80, thumbnail_size=320, archive_originals=True)
+    traps = trapper_data_modification.Traps(ago_user=None, ago_pass=None, cache_dir=str(tmp_path / 'cache'),
+                                            workers=1, layer_workers=1, max_rate=1000, full=False,
+                                            s3_client=s3_client, media_settings=settings,
+                                            metrics=RunMetrics(job='test', logger=logger), logger=logger)
+    traps.rename_attachments(ago_layer=trap_config.TRAPS, layer_name='traps', fld_unique_id='SET_UNIQUE_ID',
+                             fld_picture='PICTURE', photo_prefix='trapsetup',
+                             out_fields=trapper_data_modification.TRAPS_FIELDS, folder='trap_setup')
+    traps.close()
+
+    bucket = trap_config.BUCKET
+    prefix = 'trapper_data_collection'
+    lst_keys = s3_client.list_keys(bucket)
+    lst_blobs = [k for k in lst_keys if k.startswith(f'{prefix}/attachment_cache/blobs/')]
+    assert len(lst_blobs) == 1
+    assert s3_client.get_object(Bucket=bucket, Key=lst_blobs[0])['Body'].read() == original[:500]
+    assert not [k for k in lst_keys if '/originals/' in k]
+
+    archive_key = f'{prefix}/trap_setup/trapsetup_t1_2024_photo1.jpg'
+    assert s3_client.get_object(Bucket=bucket, Key=archive_key)['Body'].read() == original
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=f'{prefix}/manifest.json')['Body'].read())
+    assert archive_key in manifest
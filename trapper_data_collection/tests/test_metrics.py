@@ -0,0 +1,22 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from util.metrics import RunMetrics
+
+logger = logging.getLogger('test_metrics')
+
+
+def worker_hot_spot(count):
+    return sum(i * i for i in range(count))
+
+
+def test_profile_covers_worker_threads(tmp_path):
+    metrics = RunMetrics(job='test', logger=logger, profile=True)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(worker_hot_spot, [10000] * 4))
+    metrics_file = metrics.finish(metrics_dir=str(tmp_path))
+
+    with open(metrics_file) as f:
+        lst_profile = json.load(f)['profile_top']
+    assert any('worker_hot_spot' in line for line in lst_profile)
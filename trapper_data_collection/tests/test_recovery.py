@@ -0,0 +1,99 @@
+import logging
+
+import pytest
+
+pytest.importorskip('requests')
+
+from util import clients
+from util.fakes import FakeGIS, FakeItem, FakeFeatureLayer
+from util.metrics import RunMetrics
+
+import trap_config
+import trapper_data_modification
+
+logger = logging.getLogger('test_recovery')
+
+
+class KilledRun(BaseException):
+    # raised from inside the rename pass to stand in for the runner being killed, it is not caught like an Exception
+    pass
+
+
+@pytest.fixture
+def gis(monkeypatch):
+    gis = FakeGIS()
+    fields = [{'name': name, 'type': field_type} for name, field_type in
+              [('OBJECTID', 'esriFieldTypeOID'), ('SET_UNIQUE_ID', 'esriFieldTypeString'),
+               ('PICTURE', 'esriFieldTypeString'), ('EDIT_DATE', 'esriFieldTypeDate')]]
+    traps_layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0', fields=fields,
+                                   stats=gis.stats, geometry_type='esriGeometryPoint')
+    traps_layer.add_records([{'OBJECTID': 1, 'SET_UNIQUE_ID': 'T1_2024', 'MESO_GRID_ID': None,
+                              'INCLUDE_COORDINATES': 'YES', 'TRAP_STATUS': 'Active', 'PICTURE': 'a.jpg,b.jpg',
+                              'EDIT_DATE': None}])
+    traps_layer.attachments.seed(oid=1, name='a.jpg', size=64)
+    traps_layer.attachments.seed(oid=1, name='b.jpg', size=64)
+    checks_table = FakeFeatureLayer(url='https://fake.arcgis.local/trap_checks/FeatureServer/0', fields=fields,
+                                    stats=gis.stats)
+    gis.add_item(FakeItem(trap_config.TRAPS, layers=[traps_layer], tables=[checks_table]))
+    monkeypatch.setattr(clients, 'connect_gis', lambda **kwargs: gis)
+    return gis
+
+
+def make_traps(cache_dir):
+    return trapper_data_modification.Traps(ago_user=None, ago_pass=None, cache_dir=str(cache_dir), workers=1,
+                                           layer_workers=1, max_rate=1000, full=False, s3_client=None,
+                                           metrics=RunMetrics(job='test', logger=logger), logger=logger)
+
+
+def rename_traps(traps):
+    traps.rename_attachments(ago_layer=trap_config.TRAPS, layer_name='traps', fld_unique_id='SET_UNIQUE_ID',
+                             fld_picture='PICTURE', photo_prefix='trapsetup',
+                             out_fields=trapper_data_modification.TRAPS_FIELDS, folder='trap_setup')
+
+
+def get_state(gis):
+    traps_layer = gis.dict_items[trap_config.TRAPS].layers[0]
+    lst_names = sorted(a['name'] for a in traps_layer.attachments.get_list(oid=1))
+    return lst_names, sorted(traps_layer.lst_records[0]['PICTURE'].split(','))
+
+
+def test_recover_after_killed_rename_keeps_names_unique(gis, tmp_path):
+    traps = make_traps(tmp_path)
+    rename_attachment = traps.rename_attachment
+
+    def rename_first_only(task, **kwargs):
+        if task.attach_name != 'a.jpg':
+            raise KilledRun()
+        rename_attachment(task=task, **kwargs)
+
+    traps.rename_attachment = rename_first_only
+    with pytest.raises(KilledRun):
+        rename_traps(traps)
+    assert get_state(gis)[0] == ['b.jpg', 'trapsetup_t1_2024_photo1.jpg']
+
+    traps = make_traps(tmp_path)
+    traps.recover()
+    assert get_state(gis)[1] == ['b.jpg', 'trapsetup_t1_2024_photo1.jpg']
+    rename_traps(traps)
+
+    expected = ['trapsetup_t1_2024_photo1.jpg', 'trapsetup_t1_2024_photo2.jpg']
+    assert get_state(gis) == (expected, expected)
+
+
+def test_failed_rename_is_numbered_after_kept_names(gis, tmp_path):
+    traps = make_traps(tmp_path)
+    rename_attachment = traps.rename_attachment
+
+    def fail_second(task, **kwargs):
+        if task.attach_name != 'a.jpg':
+            raise Exception('upload failed')
+        rename_attachment(task=task, **kwargs)
+
+    traps.rename_attachment = fail_second
+    rename_traps(traps)
+    assert get_state(gis)[1] == ['b.jpg', 'trapsetup_t1_2024_photo1.jpg']
+
+    rename_traps(make_traps(tmp_path))
+
+    expected = ['trapsetup_t1_2024_photo1.jpg', 'trapsetup_t1_2024_photo2.jpg']
+    assert get_state(gis) == (expected, expected)
@@ -0,0 +1,81 @@
+import json
+import logging
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('pandas')
+
+from util import clients
+from util.fakes import FakeGIS, FakeItem, FakeFeatureLayer
+from util.metrics import RunMetrics
+
+import trap_config
+import trapper_data_modification
+
+logger = logging.getLogger('test_trap_status')
+
+# 2024-01-01 00:00:00 UTC, edits before it are older than the saved watermark and edits after it newer
+MARK_MS = 1704067200000
+OLD_MS = MARK_MS - 24 * 60 * 60 * 1000
+NEW_MS = MARK_MS + 24 * 60 * 60 * 1000
+
+
+def make_gis(monkeypatch, lst_traps, lst_checks):
+    gis = FakeGIS()
+    fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'EDIT_DATE', 'type': 'esriFieldTypeDate'}]
+    traps_layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0', fields=fields,
+                                   stats=gis.stats, geometry_type='esriGeometryPoint')
+    traps_layer.add_records(lst_traps)
+    checks_table = FakeFeatureLayer(url='https://fake.arcgis.local/trap_checks/FeatureServer/0', fields=fields,
+                                    stats=gis.stats)
+    checks_table.add_records(lst_checks)
+    gis.add_item(FakeItem(trap_config.TRAPS, layers=[traps_layer], tables=[checks_table]))
+    monkeypatch.setattr(clients, 'connect_gis', lambda **kwargs: gis)
+    return traps_layer
+
+
+def run_update(cache_dir, dict_state):
+    with open(cache_dir / 'modification_watermarks.json', 'w') as f:
+        json.dump(dict_state, f)
+    traps = trapper_data_modification.Traps(ago_user=None, ago_pass=None, cache_dir=str(cache_dir), workers=1,
+                                            layer_workers=1, max_rate=1000, full=False, s3_client=None,
+                                            metrics=RunMetrics(job='test', logger=logger), logger=logger)
+    traps.update_trap_status()
+
+
+def make_trap(oid, set_id, status, edit_date=OLD_MS):
+    return {'OBJECTID': oid, 'SET_UNIQUE_ID': set_id, 'TRAP_STATUS': status, 'EDIT_DATE': edit_date}
+
+
+def make_check(oid, set_id, number, status, edit_date=OLD_MS):
+    return {'OBJECTID': oid, 'SET_UNIQUE_ID': set_id, 'TRAP_CHECK_NUMBER': number, 'TRAP_STATUS': status,
+            'EDIT_DATE': edit_date}
+
+
+def test_status_comes_from_highest_check_number(monkeypatch, tmp_path):
+    traps_layer = make_gis(monkeypatch, [make_trap(1, 'T1_2024', 'Active')],
+                           [make_check(1, 'T1_2024', 3, 'Removed'), make_check(2, 'T1_2024', 1, 'Active'),
+                            make_check(3, 'T1_2024', 2, 'Sprung')])
+    run_update(tmp_path, {})
+
+    assert traps_layer.lst_records[0]['TRAP_STATUS'] == 'Removed'
+
+
+def test_only_traps_watermark_compares_every_trap(monkeypatch, tmp_path):
+    # the trap was not edited since its mark and the trap checks have no mark, e.g. they were held last run
+    traps_layer = make_gis(monkeypatch, [make_trap(1, 'T1_2024', 'Active')],
+                           [make_check(1, 'T1_2024', 1, 'Removed')])
+    run_update(tmp_path, {'traps': {'edit_date': MARK_MS, 'objectid': 1}})
+
+    assert traps_layer.lst_records[0]['TRAP_STATUS'] == 'Removed'
+
+
+def test_only_checks_watermark_uses_every_check(monkeypatch, tmp_path):
+    # only the older check was edited since the mark, the latest check still decides the status
+    traps_layer = make_gis(monkeypatch, [make_trap(1, 'T1_2024', 'Active')],
+                           [make_check(1, 'T1_2024', 1, 'Active', edit_date=NEW_MS),
+                            make_check(2, 'T1_2024', 2, 'Removed')])
+    run_update(tmp_path, {'trap checks': {'edit_date': MARK_MS, 'objectid': 2}})
+
+    assert traps_layer.lst_records[0]['TRAP_STATUS'] == 'Removed'
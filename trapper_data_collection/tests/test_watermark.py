@@ -0,0 +1,56 @@
+import logging
+
+from util.fakes import FakeFeatureLayer, RequestStats
+from util.watermark import WatermarkState
+
+logger = logging.getLogger('test_watermark')
+
+# 2024-01-01 00:00:00 UTC
+START_MS = 1704067200000
+
+
+def make_layer(count):
+    layer = FakeFeatureLayer(url='https://fake.arcgis.local/traps/FeatureServer/0',
+                             fields=[{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+                                     {'name': 'EDIT_DATE', 'type': 'esriFieldTypeDate'}], stats=RequestStats())
+    layer.add_records([{'OBJECTID': oid, 'EDIT_DATE': START_MS} for oid in range(1, count + 1)])
+    return layer
+
+
+def save_and_reload(watermarks, state_path):
+    watermarks.save()
+    reloaded = WatermarkState(logger=logger, state_path=state_path)
+    reloaded.load()
+    return reloaded
+
+
+def test_deleted_features_are_a_change(tmp_path):
+    state_path = str(tmp_path / 'watermarks.json')
+    layer = make_layer(3)
+    watermarks = WatermarkState(logger=logger, state_path=state_path)
+    watermarks.load()
+    assert watermarks.has_changes(lst_layers=[('traps', layer)], logger=logger)
+
+    watermarks = save_and_reload(watermarks, state_path)
+    assert not watermarks.has_changes(lst_layers=[('traps', layer)], logger=logger)
+
+    layer.edit_features(deletes='2')
+    assert watermarks.has_changes(lst_layers=[('traps', layer)], logger=logger)
+    watermarks = save_and_reload(watermarks, state_path)
+    assert not watermarks.has_changes(lst_layers=[('traps', layer)], logger=logger)
+
+
+def test_where_boundary():
+    # the mark carries milliseconds, which the where clause drops, and features without an edit date are picked up
+    # by OBJECTID past the mark's
+    mark_ms = START_MS + 500
+    watermarks = WatermarkState(logger=logger)
+    watermarks.dict_state = {'traps': {'edit_date': mark_ms, 'objectid': 5}}
+    layer = make_layer(0)
+    layer.add_records([{'OBJECTID': 1, 'EDIT_DATE': START_MS - 1}, {'OBJECTID': 2, 'EDIT_DATE': START_MS},
+                       {'OBJECTID': 3, 'EDIT_DATE': mark_ms - 1}, {'OBJECTID': 4, 'EDIT_DATE': mark_ms},
+                       {'OBJECTID': 5, 'EDIT_DATE': None}, {'OBJECTID': 6, 'EDIT_DATE': None},
+                       {'OBJECTID': 7, 'EDIT_DATE': START_MS + 1000}])
+
+    lst_where = [f.attributes['OBJECTID'] for f in layer.query(where=watermarks.where('traps')).features]
+    assert lst_where == [2, 3, 4, 6, 7]
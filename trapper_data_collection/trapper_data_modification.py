@@ -1,24 +1,98 @@
 import sys, os
-import pandas as pd
-from arcgis.gis import GIS
-from copy import deepcopy
+import shutil
+import tempfile
+from collections import namedtuple
 from datetime import datetime, timedelta
 from argparse import ArgumentParser
 import logging
 
 from util.environment import Environment
+from util.attachments import get_attachment_inventory
+from util.transfer import TransferPool, run_concurrently, DEFAULT_WORKERS, DEFAULT_LAYER_WORKERS
+from util.watermark import WatermarkState
+from util.queries import build_in_clauses, query_records
+from util.snapshot import SnapshotCache
+from util.edit_applier import EditApplier
+from util.metrics import RunMetrics
+from util.attachment_cache import AttachmentCache
+from util.journal import RunJournal
+from util.clients import build_run_clients, create_s3_client, get_pool_size, DEFAULT_MAX_RATE
+from util.projects import project_from_config
+from util.object_manifest import ObjectManifest
+from util.media import MediaProcessor, MediaSettings, DEFAULT_MAX_DIMENSION, DEFAULT_QUALITY, DEFAULT_THUMBNAIL_SIZE
 
 import trap_config
 
+# distance in layer units within which a trap is considered to be sitting on its meso grid centroid
+CENTROID_TOLERANCE = 0.0001
+
+# fields read from each layer, shared by every stage so each layer is only downloaded once per run
+TRAPS_FIELDS = 'OBJECTID,SET_UNIQUE_ID,MESO_GRID_ID,INCLUDE_COORDINATES,TRAP_STATUS,PICTURE'
+TRAP_CHECK_FIELDS = 'OBJECTID,SET_UNIQUE_ID,TRAP_CHECK_NUMBER,TRAP_STATUS,PICTURE'
+FISHER_FIELDS = 'OBJECTID,OBSERVATION_TYPE,PICTURE'
+
+RenameTask = namedtuple('RenameTask', ['oid', 'attach_id', 'attach_name', 'size', 'new_file_name'])
 
-def run_app():
-    ago_user, ago_pass, logger = get_input_parameters()
-    traps = Traps(ago_user=ago_user, ago_pass=ago_pass, logger=logger)
-    traps.shift_traps()
-    traps.update_trap_status()
-    traps.update_attachments()
 
-    del traps
+def run_app():
+    ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, cache_dir, workers, layer_workers, max_rate, \
+        full, check, media_settings, profile, metrics_dir, logger = get_input_parameters()
+    metrics = RunMetrics(job='trapper_data_modification', logger=logger, profile=profile)
+    run_modification(ago_user=ago_user, ago_pass=ago_pass, obj_store_user=obj_store_user,
+                     obj_store_secret=obj_store_secret, obj_store_host=obj_store_host, cache_dir=cache_dir,
+                     workers=workers, layer_workers=layer_workers, max_rate=max_rate, full=full, check=check,
+                     media_settings=media_settings, metrics_dir=metrics_dir, metrics=metrics, logger=logger)
+
+
+def run_modification(ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, cache_dir, workers,
+                     layer_workers, max_rate, full, check, media_settings, metrics_dir, metrics, logger, project=None,
+                     limiter=None, token_path=None) -> None:
+    """
+    Function:
+        Runs every stage of the modification job for one project, recording them in the run metrics. The project defaults to
+        the one in trap_config, the multi-project runner passes its own along with the limiter shared by its processes.
+    Returns:
+        None
+    """
+    project = project or project_from_config(trap_config)
+    metrics.set_parameters(project=project.name, workers=workers, layer_workers=layer_workers, max_rate=max_rate,
+                           full=full, media=media_settings._asdict() if media_settings else None)
+    s3_client = None
+    if obj_store_host:
+        s3_client = create_s3_client(obj_store_user=obj_store_user, obj_store_secret=obj_store_secret,
+                                     obj_store_host=obj_store_host, pool_size=get_pool_size(workers))
+    try:
+        traps = Traps(ago_user=ago_user, ago_pass=ago_pass, cache_dir=cache_dir, workers=workers,
+                      layer_workers=layer_workers, max_rate=max_rate, full=full, s3_client=s3_client,
+                      media_settings=media_settings, project=project, limiter=limiter, token_path=token_path,
+                      metrics=metrics, logger=logger)
+        if check:
+            with metrics.stage('check'):
+                has_changes = traps.has_changes()
+            if not has_changes:
+                logger.info('Nothing has changed since the last run, exiting')
+                metrics.status = 'skipped'
+                return
+        with metrics.stage('recover'):
+            traps.recover()
+        with metrics.stage('shift_traps'):
+            traps.shift_traps()
+        with metrics.stage('update_trap_status'):
+            traps.update_trap_status()
+        with metrics.stage('update_attachments'):
+            traps.update_attachments()
+        with metrics.stage('save_state'):
+            traps.watermarks.save()
+            traps.attachment_cache.save()
+            traps.journal.clear()
+            traps.close()
+            metrics.increment('agol throttled responses', traps.rate_limiter.throttled)
+        metrics.status = 'succeeded'
+
+        del traps
+    finally:
+        metrics.finish(metrics_dir=metrics_dir, s3_client=s3_client, bucket=project.bucket,
+                       prefix=f'{project.prefix}/metrics')
 
 
 def get_input_parameters():
@@ -35,6 +109,31 @@ def get_input_parameters():
         parser.add_argument('--log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                             help='Log level')
         parser.add_argument('--log_dir', help='Path to log directory')
+        parser.add_argument('--cache_dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'),
+                            help='Path to the local reference data cache')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of attachments transferred concurrently, shared by all layers')
+        parser.add_argument('--layer_workers', type=int, default=DEFAULT_LAYER_WORKERS,
+                            help='Number of layers processed concurrently, 1 processes them in sequence')
+        parser.add_argument('--max_rate', type=float, default=DEFAULT_MAX_RATE,
+                            help='Most AGOL requests per second, lowered automatically when AGOL throttles')
+        parser.add_argument('--full', action='store_true',
+                            help='Process every feature instead of only those edited since the last run')
+        parser.add_argument('--check', action='store_true',
+                            help='Exit straight after connecting if nothing has been edited since the last run')
+        parser.add_argument('--compress_photos', action='store_true',
+                            help='Downsize and re-encode photos before they are re-uploaded, with thumbnails for the report')
+        parser.add_argument('--max_dimension', type=int, default=DEFAULT_MAX_DIMENSION,
+                            help='Longest side in pixels of compressed photos')
+        parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY, help='JPEG quality of compressed photos')
+        parser.add_argument('--thumbnail_size', type=int, default=DEFAULT_THUMBNAIL_SIZE,
+                            help='Longest side in pixels of report thumbnails')
+        parser.add_argument('--media_workers', type=int, default=os.cpu_count(),
+                            help='Number of processes compressing photos')
+        parser.add_argument('--archive_originals', action='store_true',
+                            help='Keep the original bytes of compressed photos in their report folder in object storage')
+        parser.add_argument('--profile', action='store_true',
+                            help='Capture a cProfile of the run alongside the metrics file')
 
         args = parser.parse_args()
         try:
@@ -43,11 +142,23 @@ def get_input_parameters():
         except:
             ago_user = os.environ['AGO_USER']
             ago_pass = os.environ['AGO_PASS']
+        # object storage is only used for the shared attachment cache and the run metrics, the job runs without it
+        obj_store_user = getattr(trap_config, 'OBJ_STORE_USER', os.environ.get('OBJ_STORE_USER'))
+        obj_store_secret = getattr(trap_config, 'OBJ_STORE_SECRET', os.environ.get('OBJ_STORE_SECRET'))
+        obj_store_host = getattr(trap_config, 'OBJ_STORE_HOST', os.environ.get('OBJ_STORE_HOST'))
 
 
+        media_settings = None
+        if args.compress_photos:
+            media_settings = MediaSettings(workers=args.media_workers, max_dimension=args.max_dimension,
+                                           quality=args.quality, thumbnail_size=args.thumbnail_size,
+                                           archive_originals=args.archive_originals)
+
         logger = Environment.setup_logger(args)
 
-        return ago_user, ago_pass, logger
+        return ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, args.cache_dir, args.workers, \
+            args.layer_workers, args.max_rate, args.full, args.check, media_settings, args.profile, \
+            args.log_dir or os.getcwd(), logger
 
     except Exception as e:
         logging.error('Unexpected exception. Program terminating: {}'.format(e.message))
@@ -55,122 +166,299 @@ def get_input_parameters():
 
 
 class Traps:
-    def __init__(self, ago_user, ago_pass, logger) -> None:
+    def __init__(self, ago_user, ago_pass, cache_dir, workers, layer_workers, max_rate, full, s3_client, metrics,
+                 logger, media_settings=None, project=None, limiter=None, token_path=None) -> None:
         self.ago_user = ago_user
         self.ago_pass = ago_pass
+        self.cache_dir = cache_dir
+        self.metrics = metrics
         self.logger = logger
 
-        self.portal_url = trap_config.MAPHUB
-        self.ago_traps = trap_config.TRAPS
-        self.ago_mesogrid = trap_config.MESO_GRID
-        self.ago_fisher = trap_config.FISHER
-
-        self.logger.info('Connecting to map hub')
-        self.gis = GIS(url=self.portal_url, username=self.ago_user, password=self.ago_pass, expiration=9999)
-        self.logger.info('Connection successful')
+        project = project or project_from_config(trap_config)
+        self.portal_url = project.maphub
+        self.ago_traps = project.traps
+        self.ago_mesogrid = project.meso_grid
+        self.ago_fisher = project.fisher
+        self.trapper_bucket = project.bucket
+        self.bucket_prefix = project.prefix
+
+        clients = build_run_clients(url=self.portal_url, username=self.ago_user, password=self.ago_pass,
+                                    cache_dir=self.cache_dir, workers=workers, max_rate=max_rate, metrics=self.metrics,
+                                    logger=self.logger, limiter=limiter, token_path=token_path)
+        self.gis, self.rate_limiter, self.limiter = clients
+
+        self.snapshots = SnapshotCache(gis=self.gis, logger=self.logger)
+        self.mesogrid_cache = None
+        self.layer_workers = layer_workers
+        self.transfer_pool = TransferPool(logger=self.logger, workers=workers, limiter=self.limiter)
+        self.edit_applier = EditApplier(logger=self.logger, workers=workers, limiter=self.limiter)
+        self.watermarks = WatermarkState(logger=self.logger, full=full,
+                                         state_path=os.path.join(self.cache_dir, 'modification_watermarks.json'))
+        self.watermarks.load()
+        if s3_client is not None:
+            self.metrics.watch_s3(s3_client)
+        # attachment bytes are only kept on disk when there is no bucket to hold them, the cache directory is carried
+        # between CI runs and should stay small
+        attachment_dir = os.path.join(self.cache_dir, 'attachments') if s3_client is None else None
+        self.attachment_cache = AttachmentCache(logger=self.logger, cache_dir=attachment_dir, s3_client=s3_client,
+                                                bucket=self.trapper_bucket, prefix=f'{self.bucket_prefix}/attachment_cache')
+        self.attachment_cache.load()
+        self.journal = RunJournal(path=os.path.join(self.cache_dir, 'modification_journal.jsonl'), logger=self.logger)
+        self.journal.load()
+        self.media = None
+        if media_settings is not None:
+            manifest = None
+            if media_settings.archive_originals and s3_client is not None:
+                # originals are archived in the report folders, so they go in the reporting job's manifest
+                manifest = ObjectManifest(s3_client=s3_client, bucket=self.trapper_bucket, prefix=self.bucket_prefix,
+                                          logger=self.logger)
+                manifest.load(folders=['trap_setup', 'trap_check', 'fisher'])
+            self.media = MediaProcessor(settings=media_settings, logger=self.logger, s3_client=s3_client,
+                                        bucket=self.trapper_bucket, prefix=self.bucket_prefix, manifest=manifest)
+
+    def close(self) -> None:
+        """
+        Function:
+            Shuts down the photo compression processes
+        Returns:
+            None
+        """
+        if self.media is not None:
+            self.media.close()
 
     def __del__(self) -> None:
         self.logger.info('Disconnecting from maphub')
         del self.gis
 
+    def get_layer(self, layer_name):
+        """
+        Function:
+            Gets the feature layer or table for one of the traps, trap checks or fisher layers
+        Returns:
+            FeatureLayer or Table
+        """
+        ago_item = self.snapshots.get_item(self.ago_fisher if layer_name == 'fisher' else self.ago_traps)
+        return ago_item.tables[0] if layer_name == 'trap checks' else ago_item.layers[0]
+
+    def has_changes(self) -> bool:
+        """
+        Function:
+            WatermarkState.has_changes over the traps, trap checks and fisher layers, also True when the journal holds
+            photo name updates an interrupted run left pending
+        Returns:
+            bool: True if the run has anything to do
+        """
+        changed = self.watermarks.has_changes(lst_layers=[(layer_name, self.get_layer(layer_name))
+                                                          for layer_name in ['traps', 'trap checks', 'fisher']],
+                                              logger=self.logger)
+        return changed or bool(self.journal.lst_entries)
+
+    def recover(self) -> None:
+        """
+        Function:
+            Applies the photo name updates left pending by an interrupted run before anything else runs. Attachments that run had
+            already renamed on the server get their PICTURE value from the journalled rename plan, so the rename pass sees them as
+            done instead of renaming them again. The journal is kept if any update fails so the next run retries it.
+        Returns:
+            None
+        """
+        set_renamed = {(e['layer'], e['attach_id']) for e in self.journal.entries('renamed')}
+        set_updated = {(e['layer'], oid) for e in self.journal.entries('updated') for oid in e['oids']}
+        dict_plans = {(e['layer'], e['oid']): e for e in self.journal.entries('plan')}
+
+        dict_updates = {}
+        for (layer_name, oid), plan in dict_plans.items():
+            if (layer_name, oid) in set_updated or \
+                    not any((layer_name, attach_id) in set_renamed for _, _, attach_id in plan['names']):
+                continue
+            picture = ','.join(new_file_name if (layer_name, attach_id) in set_renamed else attach_name
+                               for attach_name, new_file_name, attach_id in plan['names'])
+            dict_updates.setdefault(layer_name, []).append({'attributes': {'OBJECTID': oid, plan['field']: picture}})
+
+        all_succeeded = True
+        for layer_name, features_for_update in dict_updates.items():
+            self.logger.info(f'Applying {len(features_for_update)} photo name update(s) left pending on {layer_name}')
+            summary = self.apply_updates(ago_flayer=self.get_layer(layer_name), updates=features_for_update,
+                                         layer_name=layer_name)
+            all_succeeded = all_succeeded and summary.all_succeeded
+        if all_succeeded:
+            self.journal.clear()
+
     def shift_traps(self):
         """
         Function:
             Shifts the trap points in teh AGOL feature layer to the centre of the meso grid if the user indicated to not include coordinates.
+            Traps that already sit on their meso grid centroid are skipped.
         Returns:
             None
         """
+        import pandas as pd
+
         self.logger.info('Shifting any traps that indicated the coordinates should not be included')
-        traps_item = self.gis.content.get(self.ago_traps)
+        traps_item = self.snapshots.get_item(self.ago_traps)
         traps_flayer = traps_item.layers[0]
-        traps_fset = traps_flayer.query(where='INCLUDE_COORDINATES=\'NO\'')
-        if len(traps_fset) > 0:
-            self.logger.info(f'Found {len(traps_fset)} trap(s) that did not include coordinates')
-            grid_list = traps_fset.sdf['MESO_GRID_ID'].tolist()
-            str_list = ','.join([f'\'{a}\'' for a in grid_list])
-            sql = f'MesoCell IN ({str_list})'
-            mesogrid_item = self.gis.content.get(self.ago_mesogrid)
-            mesogrid_flayer = mesogrid_item.layers[0]
-            mesogrid_fset = mesogrid_flayer.query(where=sql)
-            overlap_rows = pd.merge(left = traps_fset.sdf, right = mesogrid_fset.sdf, how='inner',
-                               left_on = 'MESO_GRID_ID', right_on='MesoCell')
-
-            features_for_update = [] #list containing corrected features
-            all_features = traps_fset.features
-            traps_fset.spatial_reference
-            self.logger.info('Updating geometry for traps')
-            for trap_set in overlap_rows['SET_UNIQUE_ID']:
-                # get the feature to be updated
-                original_feature = [f for f in all_features if f.attributes['SET_UNIQUE_ID'] == trap_set][0]
-                mesogrid_id = original_feature.attributes['MESO_GRID_ID']
-                feature_to_be_updated = deepcopy(original_feature)
-
-                matching_row = mesogrid_fset.sdf.where(mesogrid_fset.sdf.MesoCell == mesogrid_id).dropna()
-
-                input_geometry = {'y':float(matching_row['CENTROID_Y']),
-                                   'x': float(matching_row['CENTROID_X'])}
-                feature_to_be_updated.geometry = input_geometry
-
-                features_for_update.append(feature_to_be_updated)
-
-            if features_for_update:
-                self.logger.info(f'Updating {len(features_for_update)} trap(s)')
-                traps_flayer.edit_features(updates=features_for_update)
+        lst_traps = self.snapshots.query(ago_flayer=traps_flayer, where=self.watermarks.where('traps'),
+                                         out_fields=TRAPS_FIELDS, return_geometry=True)
+        self.watermarks.observe('traps', [r['OBJECTID'] for r in lst_traps])
+        lst_traps = [r for r in lst_traps if r['INCLUDE_COORDINATES'] == 'NO']
+        if not lst_traps:
+            return
+        self.logger.info(f'Found {len(lst_traps)} trap(s) that did not include coordinates')
+
+        df_traps = pd.DataFrame({
+            'OBJECTID': [r['OBJECTID'] for r in lst_traps],
+            'MESO_GRID_ID': [r['MESO_GRID_ID'] for r in lst_traps],
+            'X': [(r['SHAPE'] or {}).get('x') for r in lst_traps],
+            'Y': [(r['SHAPE'] or {}).get('y') for r in lst_traps]
+        })
+
+        df_centroids = self.get_mesogrid_centroids(grid_ids=df_traps['MESO_GRID_ID'].dropna().unique().tolist())
+        df_traps = df_traps.join(df_centroids, on='MESO_GRID_ID', how='inner')
+        df_traps = df_traps.dropna(subset=['CENTROID_X', 'CENTROID_Y'])
+
+        df_traps[['X', 'Y', 'CENTROID_X', 'CENTROID_Y']] = df_traps[['X', 'Y', 'CENTROID_X', 'CENTROID_Y']].astype(float)
+        on_centroid = ((df_traps['X'] - df_traps['CENTROID_X']).abs() <= CENTROID_TOLERANCE) & \
+                      ((df_traps['Y'] - df_traps['CENTROID_Y']).abs() <= CENTROID_TOLERANCE)
+        df_shift = df_traps.loc[~on_centroid]
+        if df_shift.empty:
+            self.logger.info('All traps are already on their meso grid centroid')
+            return
+
+        self.logger.info('Updating geometry for traps')
+        features_for_update = [{'attributes': {'OBJECTID': int(oid)}, 'geometry': {'y': y, 'x': x}}
+                               for oid, x, y in zip(df_shift['OBJECTID'], df_shift['CENTROID_X'],
+                                                    df_shift['CENTROID_Y'])] #list containing corrected features
 
+        self.logger.info(f'Updating {len(features_for_update)} trap(s)')
+        self.apply_updates(ago_flayer=traps_flayer, updates=features_for_update, layer_name='traps')
+
+    def apply_updates(self, ago_flayer, updates, layer_name):
+        """
+        Function:
+            Sends updates through the chunked edit applier, applies the ones that succeeded to the run snapshot and holds the layer's
+            watermark back if any failed so they are retried on the next run
+        Returns:
+            EditSummary: per-feature success/failure summary
+        """
+        summary = self.edit_applier.apply(ago_flayer=ago_flayer, updates=updates, label=layer_name)
+        self.metrics.increment(f'{layer_name} updated', len(summary.lst_succeeded))
+        self.metrics.increment(f'{layer_name} update failures', len(summary.dict_failed))
+        set_succeeded = set(summary.lst_succeeded)
+        self.snapshots.apply_edits(ago_flayer=ago_flayer,
+                                   updates=[u for u in updates if u['attributes']['OBJECTID'] in set_succeeded])
+        if not summary.all_succeeded:
+            self.watermarks.hold(layer_name)
+
+        return summary
+
+    def get_mesogrid_centroids(self, grid_ids) -> 'pd.DataFrame':
+        """
+        Function:
+            Looks up meso grid centroids from the local meso grid cache, refreshing the cache only when the meso grid item has changed
+        Returns:
+            DataFrame: CENTROID_X and CENTROID_Y columns indexed by MesoCell
+        """
+        if self.mesogrid_cache is None:
+            from util.mesogrid_cache import MesoGridCache
+            self.mesogrid_cache = MesoGridCache(cache_dir=self.cache_dir, logger=self.logger)
+            self.mesogrid_cache.sync(mesogrid_item=self.snapshots.get_item(self.ago_mesogrid))
+
+        return self.mesogrid_cache.get_centroids(grid_ids=grid_ids)
 
     def update_trap_status(self) -> None:
         """
         Function:
-            Updates the trap status field in the traps feature layer on AGOL based on the trap status in the most recent trap check record
+            Updates the trap status field in the traps feature layer on AGOL based on the trap status in the most recent trap check record.
+            The trap check table is pulled once and the latest check per trap is resolved in pandas, so the number of requests does not
+            grow with the number of traps. When both layers have a watermark only traps edited, or with trap checks edited, since the
+            last run are compared, otherwise every trap is.
         Returns:
             None
         """
+        import pandas as pd
+
         self.logger.info('Updating traps layer with most recent trap check status')
-        traps_item = self.gis.content.get(self.ago_traps)
+        traps_item = self.snapshots.get_item(self.ago_traps)
         traps_flayer = traps_item.layers[0]
-        traps_fset = traps_flayer.query()
-        features_for_update = [] #list containing corrected features
-        all_features = traps_fset.features
         tbl_trap_check = traps_item.tables[0]
 
+        traps_where = self.watermarks.where('traps')
+        checks_where = self.watermarks.where('trap checks')
+        if (traps_where == '1=1') != (checks_where == '1=1'):
+            # only one layer has a saved mark, e.g. the other was held on the first run. Comparing a full pull with a
+            # partial one would pick the latest check from edited checks only, or skip traps that were not edited.
+            self.logger.info('Only one of traps and trap checks has a watermark, comparing every trap')
+            traps_where = checks_where = '1=1'
+        lst_traps = self.snapshots.query(ago_flayer=traps_flayer, where=traps_where, out_fields=TRAPS_FIELDS)
+        lst_checks = self.snapshots.query(ago_flayer=tbl_trap_check, where=checks_where,
+                                          out_fields=TRAP_CHECK_FIELDS)
+        self.watermarks.observe('traps', [r['OBJECTID'] for r in lst_traps])
+        self.watermarks.observe('trap checks', [r['OBJECTID'] for r in lst_checks])
+        if traps_where != '1=1' and checks_where != '1=1':
+            # only traps that were edited, or that had a trap check edited, since the last run need to be compared
+            set_ids = {r['SET_UNIQUE_ID'] for r in lst_traps + lst_checks}
+            set_ids.discard(None)
+            if not set_ids:
+                return
+            self.logger.info(f'Found {len(set_ids)} trap(s) with edits since the last run')
+            lst_where = build_in_clauses(field='SET_UNIQUE_ID', values=set_ids)
+            lst_traps = query_records(ago_flayer=traps_flayer, lst_where=lst_where,
+                                      out_fields='OBJECTID,SET_UNIQUE_ID,TRAP_STATUS')
+            lst_checks = query_records(ago_flayer=tbl_trap_check, lst_where=lst_where,
+                                       out_fields='OBJECTID,SET_UNIQUE_ID,TRAP_CHECK_NUMBER,TRAP_STATUS')
+        if not lst_traps or not lst_checks:
+            return
 
-        for trap in traps_fset:
-            unique_id = trap.attributes['SET_UNIQUE_ID']
-            trap_status = trap.attributes['TRAP_STATUS']
-            trap_check_subset = tbl_trap_check.query(where=f'SET_UNIQUE_ID=\'{unique_id}\'')
-            if len(trap_check_subset) == 0:
-                continue
-            lst_check_nums = trap_check_subset.sdf['TRAP_CHECK_NUMBER'].tolist()
-
-            latest_check = trap_check_subset.sdf.loc[trap_check_subset.sdf['TRAP_CHECK_NUMBER'] == lst_check_nums[-1]]
-            check_status = latest_check.iloc[0]['TRAP_STATUS']
-            if trap_status != check_status:
-                original_feature = [f for f in all_features if f.attributes['SET_UNIQUE_ID'] == unique_id][0]
-                feature_to_be_updated = deepcopy(original_feature)
-                feature_to_be_updated.attributes['TRAP_STATUS'] = check_status
-                features_for_update.append(feature_to_be_updated)
-        if features_for_update:
-            self.logger.info(f'Updating {len(features_for_update)} trap(s)')
-            traps_flayer.edit_features(updates=features_for_update)
+        df_checks = pd.DataFrame(lst_checks)
+        df_checks['TRAP_CHECK_NUMBER'] = pd.to_numeric(df_checks['TRAP_CHECK_NUMBER'], errors='coerce')
+        df_checks = df_checks.dropna(subset=['SET_UNIQUE_ID', 'TRAP_CHECK_NUMBER'])
+        latest_idx = df_checks.groupby('SET_UNIQUE_ID')['TRAP_CHECK_NUMBER'].idxmax()
+        df_latest = df_checks.loc[latest_idx, ['SET_UNIQUE_ID', 'TRAP_STATUS']]
+
+        df_traps = pd.DataFrame(lst_traps)[['OBJECTID', 'SET_UNIQUE_ID', 'TRAP_STATUS']]
+        df_compare = pd.merge(left=df_traps, right=df_latest, how='inner', on='SET_UNIQUE_ID',
+                              suffixes=('', '_CHECK'))
+        mismatch = df_compare['TRAP_STATUS'].fillna('') != df_compare['TRAP_STATUS_CHECK'].fillna('')
+        df_changed = df_compare.loc[mismatch]
+        if df_changed.empty:
+            return
+
+        features_for_update = [{'attributes': {'OBJECTID': int(oid),
+                                               'TRAP_STATUS': None if pd.isna(check_status) else check_status}}
+                               for oid, check_status in zip(df_changed['OBJECTID'], df_changed['TRAP_STATUS_CHECK'])]
+
+        self.logger.info(f'Updating {len(features_for_update)} trap(s)')
+        self.apply_updates(ago_flayer=traps_flayer, updates=features_for_update, layer_name='traps')
 
 
     def update_attachments(self) -> None:
         """
         Function:
-            Master function to rename attachments for all required layers in arcgis online
+            Master function to rename attachments for all required layers in arcgis online. The layers are independent so
+            they are processed concurrently, sharing the run's connection and request cap.
         Returns:
             None
         """
-        self.rename_attachments(ago_layer=self.ago_traps, layer_name='traps', fld_unique_id='SET_UNIQUE_ID',
-                                fld_picture='PICTURE', photo_prefix='trapsetup')
-        
-        self.rename_attachments(ago_layer=self.ago_traps, layer_name='trap checks', fld_unique_id='SET_UNIQUE_ID', fld_picture='PICTURE', photo_prefix='trapcheck')
-
-        self.rename_attachments(ago_layer=self.ago_fisher, layer_name='fisher', fld_unique_id='OBJECTID', fld_picture='PICTURE', photo_prefix='fisher')
+        def rename_layer(layer_name, **kwargs):
+            with self.metrics.timer(f'rename_attachments {layer_name}'):
+                self.rename_attachments(layer_name=layer_name, **kwargs)
+
+        run_concurrently(jobs=[
+            lambda: rename_layer(ago_layer=self.ago_traps, layer_name='traps', fld_unique_id='SET_UNIQUE_ID',
+                                 fld_picture='PICTURE', photo_prefix='trapsetup', out_fields=TRAPS_FIELDS,
+                                 folder='trap_setup'),
+            lambda: rename_layer(ago_layer=self.ago_traps, layer_name='trap checks', fld_unique_id='SET_UNIQUE_ID',
+                                 fld_picture='PICTURE', photo_prefix='trapcheck', out_fields=TRAP_CHECK_FIELDS,
+                                 folder='trap_check'),
+            lambda: rename_layer(ago_layer=self.ago_fisher, layer_name='fisher', fld_unique_id='OBJECTID',
+                                 fld_picture='PICTURE', photo_prefix='fisher', out_fields=FISHER_FIELDS,
+                                 folder='fisher')
+        ], logger=self.logger, workers=self.layer_workers, label='attachment rename')
 
         
 
-    def rename_attachments(self, ago_layer, layer_name, fld_unique_id, fld_picture, photo_prefix) -> None:
+    def rename_attachments(self, ago_layer, layer_name, fld_unique_id, fld_picture, photo_prefix, out_fields,
+                           folder) -> None:
         """
         Function:
             Function used to rename attachments in arcgis online. It downloads each attachment, renames it according to the photo prefix, and replaces the pre-existing photo in the attachments table.
@@ -178,43 +466,49 @@ class Traps:
             None
         """
         self.logger.info(f'Renaming photos on the {layer_name} layer')
-        ago_item = self.gis.content.get(ago_layer)
+        ago_item = self.snapshots.get_item(ago_layer)
         if layer_name != 'trap checks':
             ago_flayer = ago_item.layers[0]
         else:
             ago_flayer = ago_item.tables[0]
 
-        ago_fset = ago_flayer.query()
-        all_features = ago_fset.features
+        all_features = self.snapshots.query(ago_flayer=ago_flayer, where=self.watermarks.where(layer_name),
+                                            out_fields=out_fields)
         if len(all_features) == 0:
             return
-        features_for_update = []
-        lst_oids = ago_fset.sdf['OBJECTID'].tolist()
+        self.watermarks.observe(layer_name, [r['OBJECTID'] for r in all_features])
+        dict_features = {r['OBJECTID']: r for r in all_features}
+        dict_attachments = get_attachment_inventory(ago_flayer=ago_flayer, lst_oids=list(dict_features),
+                                                    logger=self.logger)
         update_count = 0
+        dict_photo_names = {} #OBJECTID -> list of (current attachment name, renamed attachment task or None)
+        lst_tasks = []
 
-        for oid in lst_oids:
-            lst_attachments = ago_flayer.attachments.get_list(oid=oid)
+        for oid, lst_attachments in dict_attachments.items():
             self.logger.debug(lst_attachments)
             if lst_attachments:
-                original_feature = [f for f in all_features if f.attributes['OBJECTID'] == oid][0]
+                original_feature = dict_features[oid]
                 if layer_name == 'trap checks':
-                    unique_id = f'{original_feature.attributes[fld_unique_id].split("_")[0]}_' \
-                                f'{original_feature.attributes["TRAP_CHECK_NUMBER"]}'
+                    unique_id = f'{original_feature[fld_unique_id].split("_")[0]}_' \
+                                f'{original_feature["TRAP_CHECK_NUMBER"]}'
                 elif layer_name == 'fisher':
-                    unique_id = f'{original_feature.attributes["OBSERVATION_TYPE"]}_' \
-                                f'{original_feature.attributes["OBJECTID"]}'
+                    unique_id = f'{original_feature["OBSERVATION_TYPE"]}_' \
+                                f'{original_feature["OBJECTID"]}'
                 else:
-                    unique_id = original_feature.attributes[fld_unique_id]
+                    unique_id = original_feature[fld_unique_id]
                 attach_num = 1
                 lst_photo_names = []
                 try:
-                    lst_pictures = original_feature.attributes[fld_picture].split(',')
+                    lst_pictures = original_feature[fld_picture].split(',')
                 except:
                     lst_pictures = []
+                # names already kept on the feature, e.g. renamed by an interrupted run, are not handed out again
+                set_kept = {attach['name'] for attach in lst_attachments
+                            if attach['name'].startswith(photo_prefix) and attach['name'] in lst_pictures}
                 bl_update = False
                 for attach in lst_attachments:
-                    if attach['name'].startswith(photo_prefix) and attach['name'] in lst_pictures:
-                        lst_photo_names.append(attach['name'])
+                    if attach['name'] in set_kept:
+                        lst_photo_names.append((attach['name'], None))
                         continue
                     attach_name = attach['name']
                     file_type = attach_name.split('.')[-1]
@@ -223,29 +517,89 @@ class Traps:
                     else:
                         type_name = 'photo'
                     new_file_name = f'{photo_prefix}_{unique_id.lower()}_{type_name}{attach_num}.{file_type}'
-                    self.logger.info(f'Renaming {attach_name} to {new_file_name}')
-                    attach_id = attach['id']
-                    attach_file = ago_flayer.attachments.download(oid=oid, attachment_id=attach_id)[0]
-                    new_attach_file = os.path.join(os.path.dirname(attach_file), new_file_name)
-                    os.rename(attach_file, new_attach_file)
-                    try:
-                        ago_flayer.attachments.update(oid=oid, attachment_id=attach_id, file_path=new_attach_file)
-                    except:
-                        self.logger.warning('File too big to update, uploading new file and deleting old')
-                        ago_flayer.attachments.add(oid=oid, file_path=new_attach_file)
-                        ago_flayer.attachments.delete(oid=oid, attachment_id=attach_id)
-                    lst_photo_names.append(new_file_name)
+                    while new_file_name in set_kept:
+                        attach_num += 1
+                        new_file_name = f'{photo_prefix}_{unique_id.lower()}_{type_name}{attach_num}.{file_type}'
+                    task = RenameTask(oid=oid, attach_id=attach['id'], attach_name=attach_name, size=attach['size'],
+                                      new_file_name=new_file_name)
+                    lst_tasks.append(task)
+                    lst_photo_names.append((attach_name, task))
                     attach_num += 1
                     bl_update = True
-                    
+
                 if bl_update:
-                    update_count += 1
-                    feature_to_be_updated = deepcopy(original_feature)
-                    feature_to_be_updated.attributes[fld_picture] = ','.join(lst_photo_names)
-                    features_for_update.append(feature_to_be_updated)
+                    dict_photo_names[oid] = lst_photo_names
+
+        # journal the plan before renaming anything so an interrupted pass can still bring PICTURE in line with the server
+        self.journal.append(*[{'op': 'plan', 'layer': layer_name, 'oid': oid, 'field': fld_picture,
+                               'names': [[attach_name, task.new_file_name if task else None, task.attach_id if task else None]
+                                         for attach_name, task in lst_photo_names]}
+                              for oid, lst_photo_names in dict_photo_names.items()])
+        lst_results = self.transfer_pool.run(func=lambda task: self.rename_attachment(ago_flayer=ago_flayer, task=task,
+                                                                                      layer_name=layer_name,
+                                                                                      folder=folder),
+                                             tasks=lst_tasks, label='attachment rename')
+        set_renamed = {r.task for r in lst_results if r.error is None}
+        self.metrics.increment(f'{layer_name} attachments renamed', len(set_renamed))
+        self.metrics.increment(f'{layer_name} attachment rename failures', len(lst_tasks) - len(set_renamed))
+        if len(set_renamed) < len(lst_tasks):
+            self.watermarks.hold(layer_name)
+
+        features_for_update = []
+        for oid, lst_photo_names in dict_photo_names.items():
+            if not any(task in set_renamed for _, task in lst_photo_names):
+                continue
+            update_count += 1
+            features_for_update.append({'attributes': {'OBJECTID': oid, fld_picture: ','.join(
+                task.new_file_name if task in set_renamed else attach_name for attach_name, task in lst_photo_names)}})
         if features_for_update:
             self.logger.info(f'Updating photo names for {update_count} {layer_name}')
-            ago_flayer.edit_features(updates=features_for_update)
+            summary = self.apply_updates(ago_flayer=ago_flayer, updates=features_for_update, layer_name=layer_name)
+            self.journal.append({'op': 'updated', 'layer': layer_name, 'oids': summary.lst_succeeded})
+
+    def rename_attachment(self, ago_flayer, task, layer_name, folder) -> None:
+        """
+        Function:
+            Renames a single attachment and replaces the attachment on the feature. The bytes come from the attachment cache
+            when they are already there, otherwise the attachment is downloaded. When photo compression is on the renamed file is
+            replaced by its compressed version before it is uploaded, and only the bytes that are uploaded are added to the cache
+            for the reporting job. Falls back to adding the renamed file and deleting the old attachment if the file is too big
+            to update.
+        Returns:
+            None
+        """
+        self.logger.info(f'Renaming {task.attach_name} to {task.new_file_name}')
+        retry = self.transfer_pool.retry_policy
+        download_dir = tempfile.mkdtemp()
+        try:
+            attach_file = os.path.join(download_dir, os.path.basename(task.attach_name))
+            sha = self.attachment_cache.get_file(ago_flayer=ago_flayer, attach_id=task.attach_id, size=task.size,
+                                                 file_path=attach_file)
+            if sha is None:
+                attach_file = retry.call(ago_flayer.attachments.download, oid=task.oid, attachment_id=task.attach_id,
+                                         save_path=download_dir)[0]
+            new_attach_file = os.path.join(download_dir, task.new_file_name)
+            os.rename(attach_file, new_attach_file)
+            if self.media is not None and self.media.process(file_path=new_attach_file, folder=folder):
+                sha = None
+                self.metrics.increment(f'{layer_name} photos compressed')
+            if sha is None:
+                sha = self.attachment_cache.put_file(ago_flayer=ago_flayer, attach_id=task.attach_id,
+                                                     file_path=new_attach_file)
+            try:
+                ago_flayer.attachments.update(oid=task.oid, attachment_id=task.attach_id, file_path=new_attach_file)
+            except:
+                self.logger.warning('File too big to update, uploading new file and deleting old')
+                result = retry.call(ago_flayer.attachments.add, oid=task.oid, file_path=new_attach_file)
+                new_attach_id = (result or {}).get('addAttachmentResult', {}).get('objectId')
+                if new_attach_id is not None:
+                    # the renamed file has a new attachment id, point it at the same cached bytes
+                    self.attachment_cache.register(ago_flayer=ago_flayer, attach_id=new_attach_id,
+                                                   size=os.path.getsize(new_attach_file), sha=sha)
+                retry.call(ago_flayer.attachments.delete, oid=task.oid, attachment_id=task.attach_id)
+            self.journal.append({'op': 'renamed', 'layer': layer_name, 'attach_id': task.attach_id})
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     run_app()
@@ -0,0 +1,208 @@
+import sys, os
+import json
+import time
+import logging
+import multiprocessing
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from util.environment import Environment
+from util.transfer import DEFAULT_LAYER_WORKERS
+from util.clients import connect_gis, DEFAULT_MAX_RATE
+from util.token_cache import TokenCache
+from util.projects import load_projects, project_from_config
+from util.metrics import RunMetrics
+
+import trap_config
+import trapper_data_modification
+import trapper_reporting
+
+# attachment transfers in flight across every project at once
+DEFAULT_BUDGET = 8
+JOBS = ['modification', 'reporting']
+# metrics job names, the same as when each script is run on its own
+DICT_JOB_NAMES = {'modification': 'trapper_data_modification', 'reporting': 'trapper_reporting'}
+
+# set in each worker process, the transfer cap shared by all of them
+WORKER_LIMITER = None
+
+
+def run_app():
+    projects, ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, settings, logger = \
+        get_input_parameters()
+
+    # log in once up front so every project process starts from the cached token instead of logging in itself
+    token_cache = TokenCache(path=settings['token_path'], logger=logger)
+    for maphub in sorted({p.maphub for p in projects}):
+        logger.info(f'Connecting to {maphub}')
+        connect_gis(url=maphub, username=ago_user, password=ago_pass, logger=logger, token_cache=token_cache)
+
+    processes = max(1, min(settings['processes'], len(projects)))
+    # the request rate is AGOL's limit for the whole account, so each process gets its share of it
+    settings['max_rate'] = settings['max_rate'] / processes
+    context = multiprocessing.get_context('spawn')
+    limiter = context.BoundedSemaphore(max(1, settings['budget']))
+    logger.info(f'Running {len(projects)} project(s) in {processes} process(es) sharing {settings["budget"]} transfers')
+
+    lst_results = []
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=init_worker,
+                             initargs=(limiter,)) as executor:
+        dict_futures = {executor.submit(run_project, project=project, ago_user=ago_user, ago_pass=ago_pass,
+                                        obj_store_user=obj_store_user, obj_store_secret=obj_store_secret,
+                                        obj_store_host=obj_store_host, settings=settings): project
+                        for project in projects}
+        for future in as_completed(dict_futures):
+            project = dict_futures[future]
+            try:
+                lst_results.extend(future.result())
+            except Exception as e:
+                logger.error(f'Project {project.name} could not be run: {e}')
+                lst_results.append({'project': project.name, 'job': None, 'status': 'failed', 'wall_s': 0,
+                                    'error': str(e), 'counts': {}})
+
+    write_summary(lst_results=lst_results, summary_dir=settings['log_dir'] or os.getcwd(), logger=logger)
+    if any(r['status'] == 'failed' for r in lst_results):
+        sys.exit(1)
+
+
+def get_input_parameters():
+    """
+    Function:
+        Sets up parameters and the logger object
+    Returns:
+        tuple: user entered parameters required for tool execution
+    """
+    try:
+        parser = ArgumentParser(description='This script runs the trapper jobs for several projects in parallel processes')
+        parser.add_argument('projects', help='Path to a json list of project configs')
+        parser.add_argument('--jobs', nargs='+', default=JOBS, choices=JOBS,
+                            help='Jobs to run for each project, in order')
+        parser.add_argument('--log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                            help='Log level')
+        parser.add_argument('--log_dir', help='Path to log directory')
+        parser.add_argument('--cache_dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'),
+                            help='Path to the local run state directory, each project gets a folder in it')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of projects run at once')
+        parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET,
+                            help='Number of attachments transferred at once across all projects')
+        parser.add_argument('--layer_workers', type=int, default=DEFAULT_LAYER_WORKERS,
+                            help='Number of layers processed concurrently within a project')
+        parser.add_argument('--max_rate', type=float, default=DEFAULT_MAX_RATE,
+                            help='Most AGOL requests per second across all projects')
+        parser.add_argument('--transfer_mode', default='stream', choices=['stream', 'download'],
+                            help='Stream attachments straight into object storage or stage them in temp files')
+        parser.add_argument('--full', action='store_true',
+                            help='Process every feature instead of only those edited since the last run')
+        parser.add_argument('--check', action='store_true',
+                            help='Skip a project\'s job if nothing has been edited since its last run')
+        parser.add_argument('--profile', action='store_true',
+                            help='Capture a cProfile of each job alongside its metrics file')
+
+        args = parser.parse_args()
+        try:
+            ago_user = trap_config.AGO_USER
+            ago_pass = trap_config.AGO_PASS
+        except:
+            ago_user = os.environ['AGO_USER']
+            ago_pass = os.environ['AGO_PASS']
+        obj_store_user = getattr(trap_config, 'OBJ_STORE_USER', os.environ.get('OBJ_STORE_USER'))
+        obj_store_secret = getattr(trap_config, 'OBJ_STORE_SECRET', os.environ.get('OBJ_STORE_SECRET'))
+        obj_store_host = getattr(trap_config, 'OBJ_STORE_HOST', os.environ.get('OBJ_STORE_HOST'))
+
+        projects = load_projects(path=args.projects, default_project=project_from_config(trap_config))
+
+        logger = Environment.setup_logger(args)
+
+        # plain values only, the settings are sent to the worker processes
+        cache_dir = os.path.abspath(args.cache_dir)
+        settings = {'jobs': args.jobs, 'log_level': args.log_level,
+                    'log_dir': os.path.abspath(args.log_dir) if args.log_dir else None, 'cache_dir': cache_dir,
+                    'token_path': os.path.join(cache_dir, 'agol_tokens.json'), 'processes': args.processes,
+                    'budget': args.budget, 'layer_workers': args.layer_workers, 'max_rate': args.max_rate,
+                    'stream': args.transfer_mode == 'stream', 'full': args.full, 'check': args.check,
+                    'profile': args.profile}
+
+        return projects, ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, settings, logger
+
+    except Exception as e:
+        logging.error('Unexpected exception. Program terminating: {}'.format(e))
+        raise Exception('Errors exist')
+
+
+def init_worker(limiter) -> None:
+    global WORKER_LIMITER
+    WORKER_LIMITER = limiter
+
+
+def run_project(project, ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, settings) -> list:
+    """
+    Function:
+        Runs the requested jobs for one project in a worker process. Each project works in its own folder of the cache
+        directory, so its state, journals and report files never clash with another project's.
+    Returns:
+        list: one result dict per job
+    """
+    project_dir = os.path.join(settings['cache_dir'], project.name)
+    os.makedirs(project_dir, exist_ok=True)
+    os.chdir(project_dir)
+    log_dir = os.path.join(settings['log_dir'], project.name) if settings['log_dir'] else None
+    logger = Environment.setup_logger(Namespace(log_level=settings['log_level'], log_dir=log_dir))
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter(f'%(asctime)s - {project.name} - %(levelname)s - %(message)s'))
+
+    lst_results = []
+    for job in settings['jobs']:
+        metrics = RunMetrics(job=DICT_JOB_NAMES[job], logger=logger, profile=settings['profile'])
+        dict_kwargs = dict(ago_user=ago_user, ago_pass=ago_pass, obj_store_user=obj_store_user,
+                           obj_store_secret=obj_store_secret, obj_store_host=obj_store_host, cache_dir=project_dir,
+                           workers=settings['budget'], layer_workers=settings['layer_workers'],
+                           max_rate=settings['max_rate'], full=settings['full'], check=settings['check'],
+                           metrics_dir=log_dir or project_dir, metrics=metrics, logger=logger, project=project,
+                           limiter=WORKER_LIMITER, token_path=settings['token_path'])
+        start = time.perf_counter()
+        error = None
+        try:
+            if job == 'modification':
+                trapper_data_modification.run_modification(media_settings=None, **dict_kwargs)
+            else:
+                trapper_reporting.run_reporting(stream=settings['stream'], **dict_kwargs)
+        except Exception as e:
+            logger.exception(f'{job} failed')
+            error = str(e)
+
+        dict_counts = {}
+        for stage in metrics.to_dict()['stages'].values():
+            for name, value in stage['counts'].items():
+                dict_counts[name] = dict_counts.get(name, 0) + value
+        lst_results.append({'project': project.name, 'job': job, 'status': metrics.status,
+                            'wall_s': round(time.perf_counter() - start, 3), 'error': error, 'counts': dict_counts})
+
+    return lst_results
+
+
+def write_summary(lst_results, summary_dir, logger) -> None:
+    """
+    Function:
+        Logs the status of every project's jobs and writes them to a single summary file
+    Returns:
+        None
+    """
+    lst_results = sorted(lst_results, key=lambda r: (r['project'], JOBS.index(r['job']) if r['job'] in JOBS else -1))
+    logger.info(f'{"project":<20} {"job":<14} {"status":<10} {"wall_s":>9}')
+    for result in lst_results:
+        logger.info(f'{result["project"]:<20} {result["job"] or "-":<14} {result["status"]:<10} '
+                    f'{result["wall_s"]:>9.1f}' + (f'  {result["error"]}' if result['error'] else ''))
+
+    os.makedirs(summary_dir, exist_ok=True)
+    summary_file = os.path.join(summary_dir, f'{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_projects_summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump({'projects': len({r['project'] for r in lst_results}),
+                   'failed': sum(1 for r in lst_results if r['status'] == 'failed'),
+                   'results': lst_results}, f, indent=2)
+    logger.info(f'Summary written to {summary_file}')
+
+
+if __name__ == '__main__':
+    run_app()
@@ -1,26 +1,88 @@
 import sys, os
-import pandas as pd
-import boto3
-import openpyxl
-from openpyxl.worksheet.dimensions import ColumnDimension, DimensionHolder
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import Alignment
-from arcgis.gis import GIS
+import shutil
+import tempfile
 from argparse import ArgumentParser
+from collections import namedtuple
 import logging
 
 from util.environment import Environment
+from util.attachments import get_attachment_inventory, open_attachment_stream
+from util.transfer import TransferPool, run_concurrently, DEFAULT_WORKERS, DEFAULT_LAYER_WORKERS
+from util.object_manifest import ObjectManifest
+from util.watermark import WatermarkState
+from util.snapshot import SnapshotCache
+from util.queries import query_records, records_to_frame
+from util.parquet_export import ParquetExporter
+from util.metrics import RunMetrics
+from util.attachment_cache import AttachmentCache
+from util.journal import RunJournal
+from util.clients import build_run_clients, create_s3_resource, get_pool_size, DEFAULT_MAX_RATE
+from util.projects import project_from_config
 
 import trap_config
 
+# size of the in-memory parts used when streaming attachments into a multipart upload
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+# parts of one streamed upload sent at once
+STREAM_MAX_CONCURRENCY = 4
+
+# fields never used by the report or the parquet export, left out of their layer downloads
+EXCLUDE_FIELDS = ['GlobalID', 'CALCULATE_DATE']
+
+CopyTask = namedtuple('CopyTask', ['oid', 'attach_id', 'attach_name', 'size', 'ostore_path'])
+
 
 def run_app():
-    ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, logger = get_input_parameters()
-    report = TrapReport(ago_user=ago_user, ago_pass=ago_pass, obj_store_user=obj_store_user, 
-                       obj_store_secret=obj_store_secret, obj_store_host=obj_store_host, logger=logger)
-    
-    report.download_attachments()
-    report.create_excel()
+    ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, cache_dir, workers, layer_workers, max_rate, \
+        stream, full, check, profile, metrics_dir, logger = get_input_parameters()
+    metrics = RunMetrics(job='trapper_reporting', logger=logger, profile=profile)
+    run_reporting(ago_user=ago_user, ago_pass=ago_pass, obj_store_user=obj_store_user,
+                  obj_store_secret=obj_store_secret, obj_store_host=obj_store_host, cache_dir=cache_dir, workers=workers,
+                  layer_workers=layer_workers, max_rate=max_rate, stream=stream, full=full, check=check,
+                  metrics_dir=metrics_dir, metrics=metrics, logger=logger)
+
+
+def run_reporting(ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, cache_dir, workers, layer_workers,
+                  max_rate, stream, full, check, metrics_dir, metrics, logger, project=None, limiter=None,
+                  token_path=None) -> None:
+    """
+    Function:
+        Runs every stage of the reporting job for one project, the reporting counterpart of
+        trapper_data_modification.run_modification
+    Returns:
+        None
+    """
+    project = project or project_from_config(trap_config)
+    metrics.set_parameters(project=project.name, workers=workers, layer_workers=layer_workers, max_rate=max_rate,
+                           stream=stream, full=full)
+    report = None
+    try:
+        report = TrapReport(ago_user=ago_user, ago_pass=ago_pass, obj_store_user=obj_store_user, 
+                           obj_store_secret=obj_store_secret, obj_store_host=obj_store_host, cache_dir=cache_dir,
+                           workers=workers, layer_workers=layer_workers, max_rate=max_rate, stream=stream, full=full,
+                           metrics=metrics, logger=logger, project=project, limiter=limiter, token_path=token_path)
+        if check:
+            with metrics.stage('check'):
+                has_changes = report.has_changes()
+            if not has_changes:
+                logger.info('Nothing has changed since the last run, exiting')
+                metrics.status = 'skipped'
+                return
+
+        with metrics.stage('download_attachments'):
+            report.download_attachments()
+        with metrics.stage('create_excel'):
+            report.create_excel()
+        with metrics.stage('export_parquet'):
+            report.export_parquet()
+        with metrics.stage('save_state'):
+            report.watermarks.save()
+            report.journal.clear()
+            metrics.increment('agol throttled responses', report.rate_limiter.throttled)
+        metrics.status = 'succeeded'
+    finally:
+        metrics.finish(metrics_dir=metrics_dir, s3_client=report.boto_resource.meta.client if report else None,
+                       bucket=project.bucket, prefix=f'{project.prefix}/metrics')
 
     del report
 
@@ -39,6 +101,22 @@ def get_input_parameters():
         parser.add_argument('--log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                             help='Log level')
         parser.add_argument('--log_dir', help='Path to log directory')
+        parser.add_argument('--cache_dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'),
+                            help='Path to the local run state directory')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of attachments transferred concurrently, shared by all layers')
+        parser.add_argument('--layer_workers', type=int, default=DEFAULT_LAYER_WORKERS,
+                            help='Number of layers processed concurrently, 1 processes them in sequence')
+        parser.add_argument('--max_rate', type=float, default=DEFAULT_MAX_RATE,
+                            help='Most AGOL requests per second, lowered automatically when AGOL throttles')
+        parser.add_argument('--transfer_mode', default='stream', choices=['stream', 'download'],
+                            help='Stream attachments straight into object storage or stage them in temp files')
+        parser.add_argument('--full', action='store_true',
+                            help='Process every feature instead of only those edited since the last run')
+        parser.add_argument('--check', action='store_true',
+                            help='Exit straight after connecting if nothing has been edited since the last run')
+        parser.add_argument('--profile', action='store_true',
+                            help='Capture a cProfile of the run alongside the metrics file')
 
         args = parser.parse_args()
         try:
@@ -56,7 +134,9 @@ def get_input_parameters():
 
         logger = Environment.setup_logger(args)
 
-        return ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, logger
+        return ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, args.cache_dir, args.workers, \
+            args.layer_workers, args.max_rate, args.transfer_mode == 'stream', args.full, args.check, args.profile, \
+            args.log_dir or os.getcwd(), logger
 
     except Exception as e:
         logging.error('Unexpected exception. Program terminating: {}'.format(e.message))
@@ -64,30 +144,58 @@ def get_input_parameters():
 
 
 class TrapReport:
-    def __init__(self, ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, logger) -> None:
+    def __init__(self, ago_user, ago_pass, obj_store_user, obj_store_secret, obj_store_host, cache_dir, workers,
+                 layer_workers, max_rate, stream, full, metrics, logger, project=None, limiter=None,
+                 token_path=None) -> None:
         self.ago_user = ago_user
         self.ago_pass = ago_pass
         self.obj_store_user = obj_store_user
         self.obj_store_secret = obj_store_secret
         self.obj_store_host = obj_store_host
+        self.metrics = metrics
         self.logger = logger
 
-        self.portal_url = trap_config.MAPHUB
-        self.ago_traps = trap_config.TRAPS
-        self.ago_fisher = trap_config.FISHER
+        project = project or project_from_config(trap_config)
+        self.portal_url = project.maphub
+        self.ago_traps = project.traps
+        self.ago_fisher = project.fisher
 
-        self.trapper_bucket = trap_config.BUCKET
-        self.bucket_prefix ='trapper_data_collection'
+        self.trapper_bucket = project.bucket
+        self.bucket_prefix = project.prefix
 
-        self.logger.info('Connecting to map hub')
-        self.gis = GIS(url=self.portal_url, username=self.ago_user, password=self.ago_pass, expiration=9999)
-        self.logger.info('Connection successful')
+        clients = build_run_clients(url=self.portal_url, username=self.ago_user, password=self.ago_pass,
+                                    cache_dir=cache_dir, workers=workers, max_rate=max_rate, metrics=self.metrics,
+                                    logger=self.logger, limiter=limiter, token_path=token_path)
+        self.gis, self.rate_limiter, self.limiter = clients
+        self.snapshots = SnapshotCache(gis=self.gis, logger=self.logger)
 
         self.logger.info('Connecting to object storage')
-        self.boto_resource = boto3.resource(service_name='s3', 
-                                            aws_access_key_id=self.obj_store_user,
-                                            aws_secret_access_key=self.obj_store_secret, 
-                                            endpoint_url=f'https://{self.obj_store_host}')
+        self.boto_resource = create_s3_resource(obj_store_user=self.obj_store_user,
+                                                obj_store_secret=self.obj_store_secret,
+                                                obj_store_host=self.obj_store_host,
+                                                pool_size=get_pool_size(workers, STREAM_MAX_CONCURRENCY))
+        self.metrics.watch_s3(self.boto_resource.meta.client)
+
+        self.layer_workers = layer_workers
+        self.transfer_pool = TransferPool(logger=self.logger, workers=workers, limiter=self.limiter)
+        self.stream = stream
+        from boto3.s3.transfer import TransferConfig
+        self.transfer_config = TransferConfig(multipart_threshold=STREAM_CHUNK_SIZE,
+                                              multipart_chunksize=STREAM_CHUNK_SIZE,
+                                              max_concurrency=STREAM_MAX_CONCURRENCY)
+        self.manifest = ObjectManifest(s3_client=self.boto_resource.meta.client, bucket=self.trapper_bucket,
+                                       prefix=self.bucket_prefix, logger=self.logger)
+        self.watermarks = WatermarkState(logger=self.logger, full=full, s3_client=self.boto_resource.meta.client,
+                                         bucket=self.trapper_bucket,
+                                         key=f'{self.bucket_prefix}/state/reporting_watermarks.json')
+        self.watermarks.load()
+        self.attachment_cache = AttachmentCache(logger=self.logger, s3_client=self.boto_resource.meta.client,
+                                                bucket=self.trapper_bucket,
+                                                prefix=f'{self.bucket_prefix}/attachment_cache')
+        self.journal = RunJournal(path=os.path.join(cache_dir, 'reporting_journal.jsonl'), logger=self.logger)
+        self.journal.load()
+        self.parquet_exporter = ParquetExporter(s3_client=self.boto_resource.meta.client, bucket=self.trapper_bucket,
+                                                prefix=self.bucket_prefix, logger=self.logger)
 
     def __del__(self) -> None:
         self.logger.info('Disconnecting from maphub')
@@ -95,91 +203,198 @@ class TrapReport:
         self.logger.info('Closing object storage connection')
         del self.boto_resource
 
-    def list_contents(self) -> list:
-        obj_bucket = self.boto_resource.Bucket(self.trapper_bucket)
-        lst_objects = []
-        for obj in obj_bucket.objects.all():
-            lst_objects.append(os.path.basename(obj.key))
-
-        return lst_objects
-
+    def has_changes(self) -> bool:
+        """
+        Function:
+            WatermarkState.has_changes over the traps, trap checks and fisher layers, also True when the journal holds
+            copies an interrupted run did not get to record
+        Returns:
+            bool: True if the run has anything to do
+        """
+        traps_item = self.snapshots.get_item(self.ago_traps)
+        changed = self.watermarks.has_changes(lst_layers=[('traps', traps_item.layers[0]),
+                                                          ('trap checks', traps_item.tables[0]),
+                                                          ('fisher', self.snapshots.get_item(self.ago_fisher).layers[0])],
+                                              logger=self.logger)
+        return changed or bool(self.journal.lst_entries)
 
     def download_attachments(self) -> None:
         """
         Function:
-            Master function to download attachments for all required layers in arcgis online
+            Master function to download attachments for all required layers in arcgis online. The layers are independent so
+            they are processed concurrently, sharing the run's connections and transfer cap.
         Returns:
             None
         """
-        lst_pictures = self.list_contents()
-
-        self.copy_to_object_storage(ago_layer=self.ago_traps, layer_name='traps', 
-                                    fld_picture='PICTURE', lst_os_pictures=lst_pictures, folder='trap_setup')
-        
-        self.copy_to_object_storage(ago_layer=self.ago_traps, layer_name='trap checks', 
-                                    fld_picture='PICTURE', lst_os_pictures=lst_pictures, folder='trap_check')
-        
-        self.copy_to_object_storage(ago_layer=self.ago_fisher, layer_name='fisher', 
-                                    fld_picture='PICTURE', lst_os_pictures=lst_pictures, folder='fisher')
+        self.manifest.load(folders=['trap_setup', 'trap_check', 'fisher'])
+        self.attachment_cache.load()
+        lst_copied = self.journal.entries('copied')
+        if lst_copied:
+            # files copied by an interrupted run go straight into the manifest so they are not copied again
+            self.logger.info(f'Recovering {len(lst_copied)} attachment copies from the journal')
+            self.manifest.restore({e['key']: {'size': e['size'], 'etag': e['etag']} for e in lst_copied})
+            self.manifest.save()
+            self.journal.clear()
+
+        def copy_layer(layer_name, **kwargs):
+            with self.metrics.timer(f'copy_to_object_storage {layer_name}'):
+                self.copy_to_object_storage(layer_name=layer_name, **kwargs)
+
+        run_concurrently(jobs=[
+            lambda: copy_layer(ago_layer=self.ago_traps, layer_name='traps', fld_picture='PICTURE', folder='trap_setup'),
+            lambda: copy_layer(ago_layer=self.ago_traps, layer_name='trap checks', fld_picture='PICTURE',
+                               folder='trap_check'),
+            lambda: copy_layer(ago_layer=self.ago_fisher, layer_name='fisher', fld_picture='PICTURE', folder='fisher')
+        ], logger=self.logger, workers=self.layer_workers, label='attachment copy')
+        self.attachment_cache.save()
         
 
-    def copy_to_object_storage(self, ago_layer, layer_name, fld_picture, lst_os_pictures, folder) -> None:
+    def copy_to_object_storage(self, ago_layer, layer_name, fld_picture, folder) -> None:
         """
         Function:
-            Function used to download attachments from arcgis online layers and copy them to object storage.
+            Function used to download attachments from arcgis online layers and copy them to object storage. Unless a full rebuild
+            is requested only features edited since the last run are checked.
         Returns:
             None
         """
         self.logger.info(f'Downloading photos on the {layer_name} layer')
-        ago_item = self.gis.content.get(ago_layer)
+        ago_item = self.snapshots.get_item(ago_layer)
         if layer_name != 'trap checks':
             ago_flayer = ago_item.layers[0]
         else:
             ago_flayer = ago_item.tables[0]
 
-        ago_fset = ago_flayer.query()
-        all_features = ago_fset.features
+        # only the photo names of edited features are needed here, the full layer is downloaded later for the report
+        all_features = query_records(ago_flayer=ago_flayer, lst_where=[self.watermarks.where(layer_name)],
+                                     out_fields=f'OBJECTID,{fld_picture}', return_geometry=False)
         if len(all_features) == 0:
             return
+        self.watermarks.observe(layer_name, [r['OBJECTID'] for r in all_features])
 
-        lst_oids = ago_fset.sdf['OBJECTID'].tolist()
+        dict_features = {r['OBJECTID']: r for r in all_features}
+        dict_attachments = get_attachment_inventory(ago_flayer=ago_flayer, lst_oids=list(dict_features),
+                                                    logger=self.logger)
 
-        for oid in lst_oids:
-            lst_attachments = ago_flayer.attachments.get_list(oid=oid)
+        lst_tasks = []
+        for oid, lst_attachments in dict_attachments.items():
             if lst_attachments:
-                original_feature = [f for f in all_features if f.attributes['OBJECTID'] == oid][0]
+                original_feature = dict_features[oid]
                 try:
-                    lst_pictures = original_feature.attributes[fld_picture].split(',')
+                    lst_pictures = original_feature[fld_picture].split(',')
                 except:
                     lst_pictures = []
-                lst_new_pictures = [pic for pic in lst_pictures if pic not in lst_os_pictures]
-                if not lst_new_pictures:
+                set_new_pictures = {pic for pic in lst_pictures
+                                    if not self.manifest.contains(f'{self.bucket_prefix}/{folder}/{pic}')}
+                if not set_new_pictures:
                     continue
 
                 for attach in lst_attachments:
                     attach_name = attach['name']
-                    if attach_name in lst_new_pictures:
-                        self.logger.info(f'Copying {attach_name} to object storage')
-                        attach_id = attach['id']
-                        attach_file = ago_flayer.attachments.download(oid=oid, attachment_id=attach_id)[0]
+                    if attach_name in set_new_pictures:
                         ostore_path = f'{self.bucket_prefix}/{folder}/{attach_name}'
+                        lst_tasks.append(CopyTask(oid=oid, attach_id=attach['id'], attach_name=attach_name,
+                                                  size=attach['size'], ostore_path=ostore_path))
+
+        lst_results = self.transfer_pool.run(func=lambda task: self.copy_attachment(ago_flayer=ago_flayer, task=task),
+                                             tasks=lst_tasks, label='attachment copy')
+        failed = sum(1 for r in lst_results if r.error is not None)
+        self.metrics.increment(f'{layer_name} attachments copied', len(lst_tasks) - failed)
+        self.metrics.increment(f'{layer_name} attachment copy failures', failed)
+        if failed:
+            self.watermarks.hold(layer_name)
+        if lst_tasks:
+            self.manifest.save()
+
+    def copy_attachment(self, ago_flayer, task) -> None:
+        """
+        Function:
+            Copies a single attachment from arcgis online to object storage. Attachments already in the attachment cache are
+            copied from it without touching arcgis online. Otherwise in stream mode the attachment body is piped into a
+            multipart upload in bounded in-memory parts, or it is downloaded to a temp file and uploaded.
+        Returns:
+            None
+        """
+        self.logger.info(f'Copying {task.attach_name} to object storage')
+        retry = self.transfer_pool.retry_policy
+        if self.attachment_cache.copy_to(ago_flayer=ago_flayer, attach_id=task.attach_id, size=task.size,
+                                         bucket=self.trapper_bucket, key=task.ostore_path):
+            self.logger.debug(f'{task.attach_name} copied from the attachment cache')
+        elif self.stream:
+            retry.call(self.stream_attachment, ago_flayer=ago_flayer, task=task)
+        else:
+            download_dir = tempfile.mkdtemp()
+            try:
+                attach_file = retry.call(ago_flayer.attachments.download, oid=task.oid, attachment_id=task.attach_id,
+                                         save_path=download_dir)[0]
+                retry.call(self.boto_resource.meta.client.upload_file, attach_file, self.trapper_bucket,
+                           task.ostore_path)
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+        entry = self.manifest.add(key=task.ostore_path)
+        self.journal.append({'op': 'copied', 'key': task.ostore_path, **entry})
+
+    def stream_attachment(self, ago_flayer, task) -> None:
+        """
+        Function:
+            Streams an attachment's HTTP body straight into an object storage multipart upload without touching disk.
+        Returns:
+            None
+        """
+        with open_attachment_stream(gis=self.gis, ago_flayer=ago_flayer, oid=task.oid,
+                                    attach_id=task.attach_id) as response:
+            self.boto_resource.meta.client.upload_fileobj(response.raw, self.trapper_bucket, task.ostore_path,
+                                                          Config=self.transfer_config)
 
-                        self.boto_resource.meta.client.upload_file(attach_file, self.trapper_bucket, ostore_path)
+
+    def get_layer_fields(self, ago_flayer) -> str:
+        """
+        Function:
+            Builds the field list downloaded for a layer, shared by the report and the parquet export so each layer is fetched once.
+        Returns:
+            str: comma separated list of field names
+        """
+        return ','.join(f['name'] for f in ago_flayer.properties.fields if f['name'] not in EXCLUDE_FIELDS)
+
+    def get_layer_records(self, ago_flayer) -> list:
+        """
+        Function:
+            Gets a layer from the run snapshot. Geometry is always requested for spatial layers so the report and the
+            parquet export are served by the same download. The report needs every row for its column widths and the
+            export every row of a month to hash it, so both hold the whole layer anyway.
+        Returns:
+            list: attribute dicts, with geometry under the SHAPE key for spatial layers
+        """
+        return self.snapshots.query(ago_flayer=ago_flayer, out_fields=self.get_layer_fields(ago_flayer),
+                                    return_geometry=bool(ago_flayer.properties.get('geometryType')))
 
 
     def create_excel(self) -> None:
+        """
+        Function:
+            Builds the report workbook. The sheets are prepared concurrently and then written one after another, since the
+            workbook itself is written row by row.
+        Returns:
+            None
+        """
+        from util.report_writer import ReportWriter
+
         self.logger.info('Creating report')
-        
+
+        lst_sheets = [('traps', self.ago_traps, ['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'SHAPE'], 'START_DATE'),
+                      ('trap checks', self.ago_traps, ['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'TRAPSET_TYPES'], 'CHECK_DATE'),
+                      ('fisher', self.ago_fisher, ['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'SHAPE'], 'OBSERVATION_DATE')]
+        lst_frames = run_concurrently(jobs=[
+            lambda sheet=sheet: self.get_sheet_frame(sheet_name=sheet[0], ago_layer=sheet[1], drop_columns=sheet[2],
+                                                     date_field=sheet[3]) for sheet in lst_sheets
+        ], logger=self.logger, workers=self.layer_workers, label='report sheet')
+
         xl_report = 'trapper_data_report.xlsx'
-        with pd.ExcelWriter(xl_report, date_format='yyyy-mm-dd', datetime_format='yyyy-mm-dd') as xl_writer:
-            self.create_sheet(xl_writer=xl_writer, sheet_name='traps', ago_layer=self.ago_traps, 
-                              drop_columns=['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'SHAPE'], date_field='START_DATE')
-            
-            self.create_sheet(xl_writer=xl_writer, sheet_name='trap checks', ago_layer=self.ago_traps, 
-                              drop_columns=['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'TRAPSET_TYPES'], date_field='CHECK_DATE')
-            
-            self.create_sheet(xl_writer=xl_writer, sheet_name='fisher', ago_layer=self.ago_fisher, 
-                              drop_columns=['GlobalID', 'OBJECTID', 'EDIT_DATE', 'CALCULATE_DATE', 'SHAPE'], date_field='OBSERVATION_DATE')
+        with ReportWriter(xl_report=xl_report, logger=self.logger) as report_writer:
+            for (sheet_name, _, _, _), df in zip(lst_sheets, lst_frames):
+                if df is not None:
+                    self.logger.info(f'Writing {sheet_name} sheet')
+                    with self.metrics.timer(f'write_sheet {sheet_name}'):
+                        report_writer.add_sheet(sheet_name=sheet_name, df=df)
 
         ostore_path = f'{self.bucket_prefix}/{os.path.basename(xl_report)}'
 
@@ -187,41 +402,59 @@ class TrapReport:
         self.boto_resource.meta.client.upload_file(xl_report, self.trapper_bucket, ostore_path)
     
 
-    def create_sheet(self, xl_writer, sheet_name, ago_layer, drop_columns, date_field) -> None:
-        self.logger.info(f'Generating {sheet_name} sheet')
-        ago_item = self.gis.content.get(ago_layer)
-        if sheet_name != 'trap checks':
-            ago_flayer = ago_item.layers[0]
-        else:
-            ago_flayer = ago_item.tables[0]
-        ago_fset = ago_flayer.query()
-        if len(ago_fset.features) == 0:
-            return
-        df = ago_fset.sdf
-        df.drop(drop_columns, axis=1, inplace=True)
-        df[date_field] = pd.to_datetime(df[date_field]).dt.date
-        df.to_excel(xl_writer, sheet_name=sheet_name, index=False)
-
-        ws = xl_writer.sheets[sheet_name]
-
-        dim_holder = DimensionHolder(worksheet=ws)
-
-        for col in range(ws.min_column, ws.max_column + 1):
-            dim_holder[get_column_letter(col)] = ColumnDimension(ws, min=col, max=col, width=20)
-
-            ws.column_dimensions = dim_holder
-        
-        for row in ws.iter_rows():
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True)
-
+    def get_sheet_frame(self, sheet_name, ago_layer, drop_columns, date_field) -> 'pd.DataFrame':
+        """
+        Function:
+            Prepares the contents of one report sheet from the run snapshot of its layer
+        Returns:
+            DataFrame: sheet contents, None if the layer is empty
+        """
+        import pandas as pd
 
-def get_col_widths(dataframe):
-    # First we find the maximum length of the index column
-    idx_max = max([len(str(s)) for s in dataframe.index.values] + [len(str(dataframe.index.name))])
-    # Then, we concatenate this to the max of the lengths of column name and its values for each column, left to right
+        self.logger.info(f'Generating {sheet_name} sheet')
+        with self.metrics.timer(f'create_sheet {sheet_name}'):
+            ago_item = self.snapshots.get_item(ago_layer)
+            if sheet_name != 'trap checks':
+                ago_flayer = ago_item.layers[0]
+            else:
+                ago_flayer = ago_item.tables[0]
+            lst_records = self.get_layer_records(ago_flayer)
+            if len(lst_records) == 0:
+                return None
+            df = records_to_frame(lst_records=lst_records, ago_flayer=ago_flayer)
+            df.drop(drop_columns, axis=1, inplace=True, errors='ignore')
+            df[date_field] = pd.to_datetime(df[date_field]).dt.date
+        self.metrics.increment(f'{sheet_name} rows', len(df))
+        return df
+
+
+    def export_parquet(self) -> None:
+        """
+        Function:
+            Writes the traps, trap checks and fisher layers to object storage as parquet partitioned by month, only
+            rewriting the partitions whose rows changed since the last export.
+        Returns:
+            None
+        """
+        self.logger.info('Exporting layers to parquet')
+        self.parquet_exporter.load()
+
+        for layer_name, ago_layer, date_field in [('traps', self.ago_traps, 'START_DATE'),
+                                                  ('trap_checks', self.ago_traps, 'CHECK_DATE'),
+                                                  ('fisher', self.ago_fisher, 'OBSERVATION_DATE')]:
+            ago_item = self.snapshots.get_item(ago_layer)
+            if layer_name != 'trap_checks':
+                ago_flayer = ago_item.layers[0]
+            else:
+                ago_flayer = ago_item.tables[0]
+            lst_records = self.get_layer_records(ago_flayer)
+            if len(lst_records) == 0:
+                continue
+            df = records_to_frame(lst_records=lst_records, ago_flayer=ago_flayer)
+            self.parquet_exporter.export_layer(layer_name=layer_name, df=df, date_field=date_field)
+
+        self.parquet_exporter.save()
 
-    return [idx_max] + [max([len(str(s)) for s in dataframe[col].values] + [len(col)]) + 4 for col in dataframe.columns]
 
 if __name__ == '__main__':
     run_app()
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+ATTACHMENT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+ATTACHMENT_CACHE_RETENTION_DAYS = 30
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class AttachmentCache:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Content-addressed cache of attachment bytes shared by the modification and reporting jobs. An index
+               maps layer url, attachment id and size to the sha256 of the bytes, and the bytes are kept once per
+               hash in a local directory and/or under a prefix in the bucket. Local blobs are evicted least
+               recently used first once the directory is over its size limit, and index entries (and their
+               bucket blobs) are dropped once unused for the retention period.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, cache_dir=None, s3_client=None, bucket=None, prefix=None,
+                 max_bytes=ATTACHMENT_CACHE_MAX_BYTES, retention_days=ATTACHMENT_CACHE_RETENTION_DAYS):
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.retention_ms = retention_days * 24 * 60 * 60 * 1000
+        self.index_key = f'{prefix}/index.json'
+        self.index_path = os.path.join(cache_dir, 'index.json') if cache_dir else None
+        self.dict_index = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Load the local and bucket indexes, keeping the most recently used entry for each attachment
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if self.index_path and os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.merge(json.load(f))
+        if self.s3_client is not None:
+            self.merge(self.get_remote_index())
+        self.logger.info(f'Loaded attachment cache index with {len(self.dict_index)} attachment(s)')
+
+    def get_remote_index(self) -> dict:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.index_key)
+            return json.loads(response['Body'].read())
+        except self.s3_client.exceptions.NoSuchKey:
+            return {}
+
+    def merge(self, dict_entries) -> None:
+        with self.lock:
+            for key, entry in dict_entries.items():
+                current = self.dict_index.get(key)
+                if current is None or entry['last_used'] > current['last_used']:
+                    self.dict_index[key] = {**entry, 'remote': entry.get('remote', False) or
+                                            bool(current and current.get('remote'))}
+
+    def get_key(self, ago_flayer, attach_id, size) -> str:
+        return f'{ago_flayer.url}|{attach_id}|{size}'
+
+    def get_blob_path(self, sha) -> str:
+        return os.path.join(self.cache_dir, 'blobs', sha[:2], sha)
+
+    def get_blob_key(self, sha) -> str:
+        return f'{self.prefix}/blobs/{sha[:2]}/{sha}'
+
+    def lookup(self, ago_flayer, attach_id, size):
+        with self.lock:
+            entry = self.dict_index.get(self.get_key(ago_flayer, attach_id, size))
+            if entry is not None:
+                entry['last_used'] = int(time.time() * 1000)
+                self.dirty = True
+            return dict(entry) if entry else None
+
+    def get_file(self, ago_flayer, attach_id, size, file_path):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Copy an attachment's cached bytes to a file, from the local directory if present and
+                      otherwise from the bucket. The bytes are checked against their hash before being used.
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table the attachment belongs to
+                attach_id: attachment id
+                size: attachment size in bytes
+                file_path: path to write the attachment to
+
+            Return: sha256 of the attachment, None if it is not in the cache
+        ------------------------------------------------------------------------------------------------------------
+        """
+        entry = self.lookup(ago_flayer, attach_id, size)
+        if entry is not None and self.cache_dir and os.path.isfile(self.get_blob_path(entry['sha256'])):
+            blob_path = self.get_blob_path(entry['sha256'])
+            shutil.copyfile(blob_path, file_path)
+            os.utime(blob_path)
+            self.record(hit=True)
+            return entry['sha256']
+
+        if entry is not None and entry.get('remote') and self.s3_client is not None:
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.get_blob_key(entry['sha256']))
+                with open(file_path, 'wb') as f:
+                    shutil.copyfileobj(response['Body'], f)
+                if hash_file(file_path) == entry['sha256']:
+                    self.store_local(file_path, entry['sha256'])
+                    self.record(hit=True)
+                    return entry['sha256']
+                self.logger.warning(f'Cached attachment {attach_id} failed its hash check, downloading it again')
+            except self.s3_client.exceptions.NoSuchKey:
+                self.logger.warning(f'Cached attachment {attach_id} is missing from object storage')
+
+        self.record(hit=False)
+        return None
+
+    def put_file(self, ago_flayer, attach_id, file_path) -> str:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Add a downloaded attachment to the cache
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table the attachment belongs to
+                attach_id: attachment id
+                file_path: path of the downloaded attachment
+
+            Return: sha256 of the attachment
+        ------------------------------------------------------------------------------------------------------------
+        """
+        sha = hash_file(file_path)
+        size = os.path.getsize(file_path)
+        self.store_local(file_path, sha)
+        remote = False
+        if self.s3_client is not None:
+            try:
+                self.s3_client.upload_file(file_path, self.bucket, self.get_blob_key(sha))
+                remote = True
+            except Exception as e:
+                self.logger.warning(f'Could not add attachment {attach_id} to the object storage cache: {e}')
+        self.register(ago_flayer, attach_id, size, sha, remote=remote)
+
+        return sha
+
+    def register(self, ago_flayer, attach_id, size, sha, remote=None) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Point an attachment id at bytes already in the cache, e.g. the id given to a renamed file that
+                      had to be added as a new attachment
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table the attachment belongs to
+                attach_id: attachment id
+                size: attachment size in bytes
+                sha: sha256 of the cached bytes
+                remote: whether the bytes are in the bucket, looked up from existing entries when not given
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        with self.lock:
+            if remote is None:
+                remote = any(e['sha256'] == sha and e.get('remote') for e in self.dict_index.values())
+            self.dict_index[self.get_key(ago_flayer, attach_id, size)] = {'sha256': sha, 'size': size,
+                                                                         'last_used': int(time.time() * 1000),
+                                                                         'remote': remote}
+            self.dirty = True
+
+    def copy_to(self, ago_flayer, attach_id, size, bucket, key) -> bool:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Copy an attachment's cached bytes to another object in object storage without downloading
+                      them, server side from the bucket cache or uploaded from the local cache
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table the attachment belongs to
+                attach_id: attachment id
+                size: attachment size in bytes
+                bucket: destination bucket
+                key: destination key
+
+            Return: True if the attachment was served from the cache
+        ------------------------------------------------------------------------------------------------------------
+        """
+        entry = self.lookup(ago_flayer, attach_id, size)
+        if entry is not None and entry.get('remote') and self.s3_client is not None:
+            try:
+                self.s3_client.copy_object(Bucket=bucket, Key=key,
+                                           CopySource={'Bucket': self.bucket, 'Key': self.get_blob_key(entry['sha256'])})
+                self.record(hit=True)
+                return True
+            except Exception as e:
+                self.logger.warning(f'Could not copy cached attachment {attach_id}: {e}')
+        if entry is not None and self.cache_dir and os.path.isfile(self.get_blob_path(entry['sha256'])) \
+                and self.s3_client is not None:
+            self.s3_client.upload_file(self.get_blob_path(entry['sha256']), bucket, key)
+            self.record(hit=True)
+            return True
+
+        self.record(hit=False)
+        return False
+
+    def store_local(self, file_path, sha) -> None:
+        if not self.cache_dir:
+            return
+        blob_path = self.get_blob_path(sha)
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # copy to a temp name first so a concurrent reader never sees a partial blob
+            tmp_path = f'{blob_path}.{threading.get_ident()}.tmp'
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+
+    def record(self, hit) -> None:
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def save(self) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Drop expired entries, trim the local directory to its size limit and save the indexes. The
+                      bucket index is re-read and merged first so entries added by the other job are kept.
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if self.hits or self.misses:
+            self.logger.info(f'Attachment cache: {self.hits} hit(s), {self.misses} miss(es)')
+        if not self.dirty:
+            return
+
+        if self.s3_client is not None:
+            self.merge(self.get_remote_index())
+
+        cutoff = int(time.time() * 1000) - self.retention_ms
+        with self.lock:
+            set_expired = {e['sha256'] for e in self.dict_index.values() if e['last_used'] < cutoff}
+            self.dict_index = {k: e for k, e in self.dict_index.items() if e['last_used'] >= cutoff}
+            set_expired -= {e['sha256'] for e in self.dict_index.values()}
+            body = json.dumps(self.dict_index)
+
+        for sha in set_expired:
+            if self.cache_dir and os.path.isfile(self.get_blob_path(sha)):
+                os.remove(self.get_blob_path(sha))
+            if self.s3_client is not None:
+                self.s3_client.delete_object(Bucket=self.bucket, Key=self.get_blob_key(sha))
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.trim_local()
+            with open(self.index_path, 'w') as f:
+                f.write(body)
+        if self.s3_client is not None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.index_key, Body=body.encode('utf-8'),
+                                      ContentType='application/json')
+        self.dirty = False
+
+    def trim_local(self) -> None:
+        blob_dir = os.path.join(self.cache_dir, 'blobs')
+        lst_blobs = [os.path.join(dir_path, name) for dir_path, _, lst_names in os.walk(blob_dir)
+                     for name in lst_names]
+        lst_blobs = sorted(((os.stat(p).st_mtime, os.path.getsize(p), p) for p in lst_blobs), reverse=True)
+        total = 0
+        removed = 0
+        for _, size, blob_path in lst_blobs:
+            total += size
+            if total > self.max_bytes:
+                os.remove(blob_path)
+                removed += 1
+        if removed:
+            self.logger.info(f'Evicted {removed} attachment(s) from the local attachment cache')
@@ -0,0 +1,85 @@
+ATTACHMENT_CHUNK_SIZE = 250
+ATTACHMENT_TIMEOUT = 300
+# attachments returned per page of an attachment query when the layer does not report its maxRecordCount
+DEFAULT_ATTACHMENT_PAGE_SIZE = 1000
+
+
+def get_attachment_inventory(ago_flayer, lst_oids, logger, chunk_size=ATTACHMENT_CHUNK_SIZE) -> dict:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Build a layer-wide attachment inventory with batched attachment queries over chunks of object ids.
+                  Each query is paged, since a chunk of features with many photos each can hold more attachments
+                  than the service returns in one response.
+
+        Parameters:
+            ago_flayer: arcgis FeatureLayer or Table with attachments enabled
+            lst_oids: list of OBJECTIDs to look up
+            logger: logger object
+            chunk_size: number of object ids sent per attachment query
+
+        Return: dict of OBJECTID -> list of attachment dicts (id, name, size, contentType) for features that have
+                at least one attachment
+    ------------------------------------------------------------------------------------------------------------
+    """
+    dict_attachments = {}
+    if not lst_oids:
+        return dict_attachments
+
+    advanced_capabilities = ago_flayer.properties.get('advancedQueryCapabilities', {})
+    if not advanced_capabilities.get('supportsQueryAttachments', False):
+        logger.warning('Layer does not support attachment queries, listing attachments one feature at a time')
+        for oid in lst_oids:
+            lst_attachments = ago_flayer.attachments.get_list(oid=oid)
+            if lst_attachments:
+                dict_attachments[oid] = lst_attachments
+        return dict_attachments
+
+    page_size = ago_flayer.properties.get('maxRecordCount') or DEFAULT_ATTACHMENT_PAGE_SIZE
+    dict_found = {}  # attachment id -> attachment dict, so a row repeated across pages is only counted once
+    for i in range(0, len(lst_oids), chunk_size):
+        chunk = lst_oids[i:i + chunk_size]
+        offset = 0
+        while True:
+            lst_rows = ago_flayer.attachments.search(object_ids=','.join(str(oid) for oid in chunk),
+                                                     max_records=page_size, offset=offset)
+            for row in lst_rows:
+                dict_found[row['ID']] = (row['PARENTOBJECTID'], {
+                    'id': row['ID'],
+                    'name': row['NAME'],
+                    'size': row['SIZE'],
+                    'contentType': row['CONTENTTYPE']
+                })
+            if len(lst_rows) < page_size:
+                break
+            offset += len(lst_rows)
+
+    for oid, attach in dict_found.values():
+        dict_attachments.setdefault(oid, []).append(attach)
+    for lst_attachments in dict_attachments.values():
+        lst_attachments.sort(key=lambda attach: attach['id'])
+
+    logger.debug(f'Found attachments on {len(dict_attachments)} of {len(lst_oids)} feature(s)')
+
+    return dict_attachments
+
+
+def open_attachment_stream(gis, ago_flayer, oid, attach_id):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Open a streaming HTTP response for a single attachment using the GIS connection's session
+
+        Parameters:
+            gis: authenticated arcgis GIS object
+            ago_flayer: arcgis FeatureLayer or Table holding the attachment
+            oid: OBJECTID of the parent feature
+            attach_id: attachment id
+
+        Return: requests Response whose raw body is a file-like object, to be closed by the caller
+    ------------------------------------------------------------------------------------------------------------
+    """
+    url = f'{ago_flayer.url}/{oid}/attachments/{attach_id}'
+    response = gis._con._session.get(url, params={'token': gis._con.token}, stream=True, timeout=ATTACHMENT_TIMEOUT)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    return response
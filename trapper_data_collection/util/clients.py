@@ -0,0 +1,246 @@
+import os
+import time
+import threading
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+
+from util.token_cache import TokenCache
+
+# requests per second sent to AGOL when it is not pushing back
+DEFAULT_MAX_RATE = 20.0
+MIN_RATE = 0.5
+DEFAULT_POOL_SIZE = 10
+THROTTLE_STATUS = {429, 503}
+THROTTLE_RETRIES = 5
+# minutes, asked for at login so a token outlives the run and can be reused by the next ones
+TOKEN_EXPIRATION = 9999
+
+RunClients = namedtuple('RunClients', ['gis', 'rate_limiter', 'limiter'])
+
+
+def get_pool_size(workers, connections_per_worker=1) -> int:
+    return max(DEFAULT_POOL_SIZE, workers * connections_per_worker)
+
+
+def connect_gis(url, username, password, logger, token_cache=None, expiration=TOKEN_EXPIRATION):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Connect to AGOL, reusing a cached token when there is a valid one and logging in otherwise.
+                  arcgis is imported here rather than at start up since it is by far the slowest import.
+
+        Parameters:
+            url: portal url
+            username: AGOL username
+            password: AGOL password
+            logger: logger object
+            token_cache: TokenCache, None to always log in
+            expiration: lifetime in minutes asked for when logging in
+
+        Return: arcgis GIS object
+    ------------------------------------------------------------------------------------------------------------
+    """
+    from arcgis.gis import GIS
+
+    token = token_cache.get(url=url, username=username, secret=password) if token_cache else None
+    if token:
+        try:
+            gis = GIS(url=url, token=token)
+            logger.info('Connected with a cached token')
+            return gis
+        except Exception as e:
+            logger.info(f'Cached token was rejected, logging in: {e}')
+            token_cache.invalidate(url=url, username=username)
+
+    gis = GIS(url=url, username=username, password=password, expiration=expiration)
+    if token_cache:
+        token_cache.put(url=url, username=username, secret=password, token=gis._con.token,
+                        expires=int(time.time() * 1000) + expiration * 60 * 1000)
+    return gis
+
+
+def create_s3_client(obj_store_user, obj_store_secret, obj_store_host, pool_size):
+    import boto3
+
+    return boto3.client(service_name='s3', aws_access_key_id=obj_store_user, aws_secret_access_key=obj_store_secret,
+                        endpoint_url=f'https://{obj_store_host}', config=build_s3_config(pool_size))
+
+
+def create_s3_resource(obj_store_user, obj_store_secret, obj_store_host, pool_size):
+    import boto3
+
+    return boto3.resource(service_name='s3', aws_access_key_id=obj_store_user, aws_secret_access_key=obj_store_secret,
+                          endpoint_url=f'https://{obj_store_host}', config=build_s3_config(pool_size))
+
+
+def build_s3_config(pool_size):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Client config for object storage with a connection pool sized for the run's workers and
+                  botocore's adaptive retry mode, which rate limits the client itself once it sees throttling
+
+        Parameters:
+            pool_size: number of connections kept open to object storage
+
+        Return: botocore Config
+    ------------------------------------------------------------------------------------------------------------
+    """
+    from botocore.config import Config
+
+    return Config(max_pool_connections=pool_size, retries={'max_attempts': 10, 'mode': 'adaptive'},
+                  tcp_keepalive=True)
+
+
+class AdaptiveRateLimiter:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Thread-safe token bucket shared by every request to a service. The rate is halved and requests are
+               paused whenever the service throttles, then creeps back up to the maximum as requests succeed.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, max_rate=DEFAULT_MAX_RATE, min_rate=MIN_RATE):
+        self.logger = logger
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def on_throttle(self, retry_after=None) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or 1 / self.rate))
+            self.throttled += 1
+            rate = self.rate
+        self.logger.warning(f'Throttled by the service, slowing to {rate:.1f} requests per second')
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: requests adapter that takes a token from the rate limiter before each request and tells it about
+               throttled responses. Throttled requests are resent once the limiter allows, unless their body is a
+               stream that cannot be replayed. Each attempt goes out through send_request.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, rate_limiter, retries=THROTTLE_RETRIES, **kwargs):
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            response = self.send_request(request, **kwargs)
+            if not self.is_throttled(response, kwargs.get('stream')):
+                self.rate_limiter.on_success()
+                return response
+            self.rate_limiter.on_throttle(self.get_retry_after(response))
+            if attempt == self.retries or not (request.body is None or isinstance(request.body, (bytes, str))):
+                return response
+            response.close()
+
+    def send_request(self, request, **kwargs):
+        return super().send(request, **kwargs)
+
+    @staticmethod
+    def is_throttled(response, stream) -> bool:
+        if response.status_code in THROTTLE_STATUS:
+            return True
+        # AGOL also reports throttling as a 200 with a json error body, only checked when the body is read anyway
+        if stream or 'json' not in response.headers.get('Content-Type', ''):
+            return False
+        return b'"code":429' in response.content[:512].replace(b' ', b'')
+
+    @staticmethod
+    def get_retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+
+def configure_gis_session(gis, rate_limiter, pool_size, logger) -> None:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Mount a pooled, rate limited adapter on the GIS connection's HTTP session so every layer,
+                  attachment and stream request shares kept-alive connections and one request rate
+
+        Parameters:
+            gis: arcgis GIS object
+            rate_limiter: AdaptiveRateLimiter shared by the run
+            pool_size: number of connections kept open to AGOL
+            logger: logger object
+
+        Return: None
+    ------------------------------------------------------------------------------------------------------------
+    """
+    session = getattr(getattr(gis, '_con', None), '_session', None)
+    if not hasattr(session, 'mount'):
+        logger.warning('GIS session does not support adapters, AGOL calls will not be rate limited')
+        return
+
+    adapter = ThrottledAdapter(rate_limiter=rate_limiter, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def build_run_clients(url, username, password, cache_dir, workers, max_rate, metrics, logger, limiter=None,
+                      token_path=None) -> RunClients:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Connect to AGOL and set up the request limits shared by everything a job does in one run. Every
+                  AGOL request shares one pool of kept-alive connections and one request rate, and a single cap on
+                  requests in flight applies however many layers are processed at once. The multi-project runner
+                  passes in a cap shared by all of its processes.
+
+        Parameters:
+            url: portal url
+            username: AGOL username
+            password: AGOL password
+            cache_dir: run state directory holding the token cache unless token_path is given
+            workers: number of requests in flight at once, also sizes the connection pool
+            max_rate: most AGOL requests per second
+            metrics: RunMetrics counting the AGOL calls
+            logger: logger object
+            limiter: optional semaphore shared with other processes, used instead of a new one
+            token_path: optional path of a token cache shared with other processes
+
+        Return: RunClients of the GIS object, its AdaptiveRateLimiter and the in-flight request limiter
+    ------------------------------------------------------------------------------------------------------------
+    """
+    logger.info('Connecting to map hub')
+    gis = connect_gis(url=url, username=username, password=password, logger=logger,
+                      token_cache=TokenCache(logger=logger, path=token_path or os.path.join(cache_dir, 'agol_tokens.json')))
+    logger.info('Connection successful')
+    rate_limiter = AdaptiveRateLimiter(logger=logger, max_rate=max_rate)
+    configure_gis_session(gis=gis, rate_limiter=rate_limiter, pool_size=get_pool_size(workers), logger=logger)
+    metrics.watch_gis(gis)
+
+    return RunClients(gis=gis, rate_limiter=rate_limiter,
+                      limiter=limiter or threading.BoundedSemaphore(max(1, workers)))
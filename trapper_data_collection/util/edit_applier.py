@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from util.transfer import RetryPolicy, DEFAULT_WORKERS
+
+EDIT_CHUNK_SIZE = 500
+
+# fragments of AGOL/HTTP error messages that mean the request was throttled and can be sent again as is
+THROTTLE_MESSAGES = ['429', 'too many requests', 'throttl', 'rate limit']
+# fragments of AGOL/HTTP error messages that mean the request was too big and may go through in smaller chunks
+SIZE_MESSAGES = ['413', '414', 'too large', 'too long', 'payload', 'exceeds', 'size limit', 'maximum size']
+
+
+def is_throttle_error(error) -> bool:
+    message = str(error).lower()
+    return any(fragment in message for fragment in THROTTLE_MESSAGES)
+
+
+def is_size_error(error) -> bool:
+    message = str(error).lower()
+    return any(fragment in message for fragment in SIZE_MESSAGES)
+
+
+class EditSummary:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Per-feature outcome of a batch of edits
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self):
+        self.lst_succeeded = []
+        self.dict_failed = {}
+
+    def __len__(self):
+        return len(self.lst_succeeded) + len(self.dict_failed)
+
+    @property
+    def all_succeeded(self) -> bool:
+        return not self.dict_failed
+
+
+class EditApplier:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Sends edit_features updates in chunks submitted in parallel. Throttled chunks are retried with
+               backoff, chunks the service rejects as too large are split in half until they go through or a
+               single feature is left, and the per-feature results are collected into an EditSummary. Any other
+               failure, including throttling that outlasts the retries, fails the chunk as a whole.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, workers=DEFAULT_WORKERS, chunk_size=EDIT_CHUNK_SIZE, limiter=None):
+        self.logger = logger
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.limiter = limiter
+        self.retry_policy = RetryPolicy(logger=logger, should_retry=is_throttle_error)
+
+    def apply(self, ago_flayer, updates, label) -> EditSummary:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Apply updates to a layer and report which features succeeded
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table
+                updates: list of feature dicts with an OBJECTID attribute
+                label: name of the features used in log messages
+
+            Return: EditSummary
+        ------------------------------------------------------------------------------------------------------------
+        """
+        summary = EditSummary()
+        if not updates:
+            return summary
+
+        lst_chunks = [updates[i:i + self.chunk_size] for i in range(0, len(updates), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(lst_chunks))) as executor:
+            lst_results = list(executor.map(lambda chunk: self.apply_chunk(ago_flayer, chunk), lst_chunks))
+
+        for lst_succeeded, dict_failed in lst_results:
+            summary.lst_succeeded.extend(lst_succeeded)
+            summary.dict_failed.update(dict_failed)
+
+        self.logger.info(f'Updated {len(summary.lst_succeeded)} of {len(updates)} {label}')
+        for oid, error in summary.dict_failed.items():
+            self.logger.warning(f'Failed to update {label} OBJECTID {oid}: {error}')
+
+        return summary
+
+    def apply_chunk(self, ago_flayer, chunk) -> tuple:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Send one chunk of updates, splitting it in half if the service rejects the request as too
+                      large. Splitting a throttled chunk would only multiply the requests, so it is not retried here.
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table
+                chunk: list of feature dicts
+
+            Return: tuple of (list of OBJECTIDs updated, dict of OBJECTID -> error)
+        ------------------------------------------------------------------------------------------------------------
+        """
+        try:
+            with self.limiter or nullcontext():
+                result = self.retry_policy.call(ago_flayer.edit_features, updates=chunk)
+        except Exception as e:
+            if len(chunk) == 1 or is_throttle_error(e) or not is_size_error(e):
+                return [], {update['attributes']['OBJECTID']: str(e) for update in chunk}
+            self.logger.warning(f'Edit of {len(chunk)} features failed ({e}), retrying in smaller chunks')
+            half = len(chunk) // 2
+            lst_first, dict_first = self.apply_chunk(ago_flayer, chunk[:half])
+            lst_second, dict_second = self.apply_chunk(ago_flayer, chunk[half:])
+            return lst_first + lst_second, {**dict_first, **dict_second}
+
+        lst_succeeded = []
+        dict_failed = {}
+        for update_result in result.get('updateResults', []):
+            if update_result.get('success'):
+                lst_succeeded.append(update_result['objectId'])
+            else:
+                error = update_result.get('error') or {}
+                dict_failed[update_result['objectId']] = error.get('description', 'unknown error')
+
+        return lst_succeeded, dict_failed
@@ -0,0 +1,517 @@
+import io
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+# where clauses the fake layers understand, which are the ones the scripts build
+IN_CLAUSE = re.compile(r"^(\w+) IN \((.*)\)$")
+WATERMARK_CLAUSE = re.compile(r"^\((\w+) >= TIMESTAMP '([^']+)' OR \(\1 IS NULL AND OBJECTID > (\d+)\)\)$")
+
+
+class RequestStats:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Thread-safe count of the requests served by the fakes and the bytes moved in each direction
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter_requests = Counter()
+        self.bytes_down = 0
+        self.bytes_up = 0
+
+    def record(self, operation, bytes_down=0, bytes_up=0) -> None:
+        with self.lock:
+            self.counter_requests[operation] += 1
+            self.bytes_down += bytes_down
+            self.bytes_up += bytes_up
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'requests': dict(self.counter_requests), 'bytes_down': self.bytes_down, 'bytes_up': self.bytes_up}
+
+
+class PropertyMap(dict):
+    # arcgis PropertyMap allows both properties.fields and properties.get('fields')
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeFeature:
+    def __init__(self, attributes, geometry=None):
+        self.attributes = attributes
+        self.geometry = geometry
+
+
+class FakeFeatureSet:
+    def __init__(self, features):
+        self.features = features
+
+    def __len__(self):
+        return len(self.features)
+
+
+def build_where_filter(where):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Turn one of the where clauses built by the scripts into a record filter
+
+        Parameters:
+            where: sql where clause, '1=1', a FIELD IN (...) clause or a watermark clause
+
+        Return: function taking an attribute dict and returning whether it matches
+    ------------------------------------------------------------------------------------------------------------
+    """
+    if where == '1=1':
+        return lambda attributes: True
+
+    match = IN_CLAUSE.match(where)
+    if match:
+        field = match.group(1)
+        set_values = {v.replace("''", "'") for v in re.findall(r"'((?:[^']|'')*)'", match.group(2))}
+        return lambda attributes: str(attributes.get(field)) in set_values
+
+    match = WATERMARK_CLAUSE.match(where)
+    if match:
+        field, timestamp, objectid = match.group(1), match.group(2), int(match.group(3))
+        edit_date = int(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+                        .replace(tzinfo=timezone.utc).timestamp() * 1000)
+        return lambda attributes: (attributes.get(field) is not None and attributes[field] >= edit_date) or \
+                                  (attributes.get(field) is None and attributes['OBJECTID'] > objectid)
+
+    raise ValueError(f'Unsupported where clause in fake layer: {where}')
+
+
+class FakeAttachmentManager:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Stand-in for FeatureLayer.attachments. Attachment bodies are generated from the attachment id rather
+               than stored, so large datasets only cost their metadata.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.lock = threading.Lock()
+        self.dict_attachments = {}  # OBJECTID -> list of attachment dicts
+        self.dict_bodies = {}  # attachment id -> bytes, only for files uploaded through the fake
+        self.next_id = 1
+
+    def seed(self, oid, name, size) -> None:
+        with self.lock:
+            self.dict_attachments.setdefault(oid, []).append({'id': self.next_id, 'name': name, 'size': size,
+                                                              'contentType': 'image/jpeg'})
+            self.next_id += 1
+
+    def get_body(self, oid, attachment_id) -> bytes:
+        with self.lock:
+            attach = next((a for a in self.dict_attachments.get(oid, []) if a['id'] == attachment_id), None)
+            if attach is None:
+                raise Exception(f'Attachment {attachment_id} not found on feature {oid}')
+            body = self.dict_bodies.get(attachment_id)
+        if body is None:
+            body = (hashlib.sha256(str(attachment_id).encode()).digest() * (attach['size'] // 32 + 1))[:attach['size']]
+        return body
+
+    def get_list(self, oid) -> list:
+        self.layer.stats.record('attachments.get_list')
+        with self.lock:
+            return [dict(a) for a in self.dict_attachments.get(oid, [])]
+
+    def search(self, object_ids, max_records=None, offset=None) -> list:
+        # like the service, a response never holds more than the layer's maxRecordCount attachments
+        set_oids = {int(oid) for oid in str(object_ids).split(',')}
+        page_size = min(max_records or self.layer.properties.maxRecordCount, self.layer.properties.maxRecordCount)
+        with self.lock:
+            lst_rows = [{'PARENTOBJECTID': oid, 'ID': a['id'], 'NAME': a['name'], 'SIZE': a['size'],
+                         'CONTENTTYPE': a['contentType']}
+                        for oid in sorted(set_oids) for a in self.dict_attachments.get(oid, [])]
+        lst_rows = lst_rows[offset or 0:(offset or 0) + page_size]
+        self.layer.stats.record('attachments.search', bytes_down=len(json.dumps(lst_rows)))
+        return lst_rows
+
+    def download(self, oid, attachment_id, save_path=None) -> list:
+        body = self.get_body(oid, attachment_id)
+        name = next(a['name'] for a in self.dict_attachments[oid] if a['id'] == attachment_id)
+        file_path = os.path.join(save_path, name)
+        with open(file_path, 'wb') as f:
+            f.write(body)
+        self.layer.stats.record('attachments.download', bytes_down=len(body))
+        return [file_path]
+
+    def update(self, oid, attachment_id, file_path) -> dict:
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            for attach in self.dict_attachments.get(oid, []):
+                if attach['id'] == attachment_id:
+                    attach.update(name=os.path.basename(file_path), size=len(body))
+                    self.dict_bodies[attachment_id] = body
+        self.layer.stats.record('attachments.update', bytes_up=len(body))
+        return {'updateAttachmentResult': {'objectId': attachment_id, 'success': True}}
+
+    def add(self, oid, file_path) -> dict:
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            attach_id = self.next_id
+            self.next_id += 1
+            self.dict_attachments.setdefault(oid, []).append({'id': attach_id, 'name': os.path.basename(file_path),
+                                                              'size': len(body), 'contentType': 'image/jpeg'})
+            self.dict_bodies[attach_id] = body
+        self.layer.stats.record('attachments.add', bytes_up=len(body))
+        return {'addAttachmentResult': {'objectId': attach_id, 'success': True}}
+
+    def delete(self, oid, attachment_id) -> dict:
+        with self.lock:
+            self.dict_attachments[oid] = [a for a in self.dict_attachments.get(oid, []) if a['id'] != attachment_id]
+            self.dict_bodies.pop(attachment_id, None)
+        self.layer.stats.record('attachments.delete')
+        return {'deleteAttachmentResults': [{'objectId': attachment_id, 'success': True}]}
+
+
+class FakeFeatureLayer:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Stand-in for an arcgis FeatureLayer or Table covering the query, edit_features and attachments calls
+               the scripts make. Records are held as attribute dicts in OBJECTID order and EDIT_DATE is stamped on
+               every edit like AGOL editor tracking.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, url, fields, stats, geometry_type=None, max_record_count=1000):
+        self.url = url
+        self.stats = stats
+        self.properties = PropertyMap(fields=fields, maxRecordCount=max_record_count,
+                                      advancedQueryCapabilities={'supportsQueryAttachments': True})
+        if geometry_type:
+            self.properties['geometryType'] = geometry_type
+        self.attachments = FakeAttachmentManager(self)
+        self.lock = threading.Lock()
+        self.lst_records = []
+        self.dict_geometry = {}
+        self.dict_index = {}
+        self.dict_where_cache = {}
+
+    def add_records(self, lst_records, lst_geometry=None) -> None:
+        with self.lock:
+            for i, record in enumerate(lst_records):
+                self.dict_index[record['OBJECTID']] = len(self.lst_records)
+                self.lst_records.append(record)
+                if lst_geometry is not None:
+                    self.dict_geometry[record['OBJECTID']] = lst_geometry[i]
+            self.dict_where_cache = {}
+
+    def query(self, where='1=1', out_fields='*', return_geometry=True, order_by_fields=None, result_offset=0,
+              result_record_count=None, return_all_records=True, **kwargs):
+        with self.lock:
+            # the matching records are cached per where clause so paging through a result stays linear
+            if where not in self.dict_where_cache:
+                where_filter = build_where_filter(where)
+                self.dict_where_cache[where] = [r for r in self.lst_records if where_filter(r)]
+            lst_matches = self.dict_where_cache[where]
+            if kwargs.get('return_count_only'):
+                self.stats.record('query')
+                return len(lst_matches)
+            if result_record_count is not None:
+                lst_matches = lst_matches[result_offset:result_offset + result_record_count]
+
+            set_fields = None if out_fields == '*' else {f.strip() for f in out_fields.split(',')} | {'OBJECTID'}
+            lst_features = []
+            for record in lst_matches:
+                attributes = dict(record) if set_fields is None else {k: v for k, v in record.items()
+                                                                      if k in set_fields}
+                geometry = dict(self.dict_geometry[record['OBJECTID']]) \
+                    if return_geometry and record['OBJECTID'] in self.dict_geometry else None
+                lst_features.append(FakeFeature(attributes, geometry))
+
+        self.stats.record('query', bytes_down=len(json.dumps([[f.attributes, f.geometry] for f in lst_features],
+                                                             default=str)))
+        return FakeFeatureSet(lst_features)
+
+    def edit_features(self, updates=None, deletes=None, **kwargs) -> dict:
+        lst_results = []
+        lst_delete_results = []
+        edit_date = int(time.time() * 1000)
+        with self.lock:
+            set_deletes = {int(oid) for oid in (deletes.split(',') if isinstance(deletes, str) else deletes or [])}
+            if set_deletes:
+                lst_delete_results = [{'objectId': oid, 'success': oid in self.dict_index} for oid in sorted(set_deletes)]
+                self.lst_records = [r for r in self.lst_records if r['OBJECTID'] not in set_deletes]
+                self.dict_index = {r['OBJECTID']: i for i, r in enumerate(self.lst_records)}
+            for update in updates or []:
+                oid = update['attributes']['OBJECTID']
+                if oid not in self.dict_index:
+                    lst_results.append({'objectId': oid, 'success': False,
+                                        'error': {'code': 1019, 'description': 'Object is missing.'}})
+                    continue
+                record = self.lst_records[self.dict_index[oid]]
+                record.update(update['attributes'])
+                if 'EDIT_DATE' in record:
+                    record['EDIT_DATE'] = edit_date
+                if update.get('geometry'):
+                    self.dict_geometry[oid] = dict(update['geometry'])
+                lst_results.append({'objectId': oid, 'success': True})
+            self.dict_where_cache = {}
+
+        self.stats.record('edit_features', bytes_up=len(json.dumps(updates, default=str)))
+        return {'addResults': [], 'updateResults': lst_results, 'deleteResults': lst_delete_results}
+
+
+class FakeItem:
+    def __init__(self, item_id, layers=None, tables=None, modified=None):
+        self.id = item_id
+        self.layers = layers or []
+        self.tables = tables or []
+        self.modified = modified if modified is not None else int(time.time() * 1000)
+
+
+class FakeRequest:
+    # enough of a requests.PreparedRequest for the adapters mounted on the session
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.body = None
+        self.headers = {}
+
+
+class FakeResponse:
+    # enough of a streamed requests.Response for open_attachment_stream, its callers and the mounted adapters
+    def __init__(self, body, request, status_code=200, headers=None):
+        self.raw = io.BytesIO(body)
+        self.request = request
+        self.url = request.url
+        self.status_code = status_code
+        self.headers = {'Content-Type': 'application/octet-stream', 'Content-Length': str(len(body)),
+                        **(headers or {})}
+
+    @property
+    def content(self) -> bytes:
+        return self.raw.getvalue()
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise Exception(f'{self.status_code} error for url: {self.url}')
+
+    def close(self) -> None:
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FakeSession:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Stand-in for the GIS connection's requests session. Adapters can be mounted and response hooks
+               registered like on a requests.Session so the rate limiter and the run metrics see the attachment
+               streams, with the adapter's transport pointed at the fake. Every throttle_every-th request is
+               answered with a 429.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, gis, throttle_every=0):
+        self.gis = gis
+        self.adapters = {}
+        self.hooks = {'response': []}
+        self.throttle_every = throttle_every
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def mount(self, prefix, adapter) -> None:
+        adapter.send_request = self.serve
+        self.adapters[prefix] = adapter
+
+    def get_adapter(self, url):
+        # the longest matching prefix wins, as in requests
+        return next((adapter for prefix, adapter in sorted(self.adapters.items(), key=lambda i: -len(i[0]))
+                     if url.lower().startswith(prefix.lower())), None)
+
+    def get(self, url, params=None, stream=False, timeout=None, **kwargs) -> FakeResponse:
+        request = FakeRequest('GET', url)
+        adapter = self.get_adapter(url)
+        if adapter is None:
+            response = self.serve(request, stream=stream, timeout=timeout)
+        else:
+            response = adapter.send(request, stream=stream, timeout=timeout)
+        for hook in self.hooks.get('response', []):
+            response = hook(response, stream=stream, timeout=timeout) or response
+        return response
+
+    def serve(self, request, **kwargs) -> FakeResponse:
+        with self.lock:
+            self.request_count += 1
+            throttled = self.throttle_every and self.request_count % self.throttle_every == 0
+        if throttled:
+            self.gis.stats.record('attachments.throttled')
+            return FakeResponse(b'', request, status_code=429, headers={'Retry-After': '0.01'})
+
+        layer_url, _, path = request.url.rpartition('/attachments/')
+        layer_url, _, oid = layer_url.rpartition('/')
+        body = self.gis.dict_layers[layer_url].attachments.get_body(int(oid), int(path))
+        self.gis.stats.record('attachments.stream', bytes_down=len(body))
+        return FakeResponse(body, request)
+
+
+class FakeConnection:
+    def __init__(self, gis, throttle_every=0):
+        self._session = FakeSession(gis, throttle_every=throttle_every)
+        self.token = 'fake-token'
+
+
+class FakeContentManager:
+    def __init__(self, gis):
+        self.gis = gis
+
+    def get(self, item_id):
+        self.gis.stats.record('content.get')
+        return self.gis.dict_items.get(item_id)
+
+
+class FakeGIS:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: In-process stand-in for an arcgis GIS connection serving FakeItems by id. Attachment streams opened
+               through gis._con._session are resolved to the fake layer they belong to, and every throttle_every-th
+               stream is throttled when it is set.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, stats=None, throttle_every=0):
+        self.stats = stats or RequestStats()
+        self.dict_items = {}
+        self.dict_layers = {}
+        self.content = FakeContentManager(self)
+        self._con = FakeConnection(self, throttle_every=throttle_every)
+
+    def add_item(self, item) -> None:
+        self.dict_items[item.id] = item
+        for layer in item.layers + item.tables:
+            self.dict_layers[layer.url] = layer
+
+
+class FakeS3Exceptions:
+    class NoSuchKey(Exception):
+        pass
+
+
+class FakePaginator:
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        lst_keys = sorted(k for k in self.s3_client.list_keys(Bucket) if k.startswith(Prefix))
+        for i in range(0, max(len(lst_keys), 1), 1000):
+            self.s3_client.stats.record('s3.list_objects_v2')
+            yield {'Contents': [self.s3_client.describe(Bucket, key) for key in lst_keys[i:i + 1000]]}
+
+
+class FakeS3Client:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Stand-in for a boto3 S3 client backed by a local directory, one sub directory per bucket, covering
+               the object calls the scripts make
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    exceptions = FakeS3Exceptions
+
+    def __init__(self, root_dir, stats=None):
+        self.root_dir = root_dir
+        self.stats = stats or RequestStats()
+
+    def get_path(self, bucket, key) -> str:
+        return os.path.join(self.root_dir, bucket, *key.split('/'))
+
+    def list_keys(self, bucket) -> list:
+        bucket_dir = os.path.join(self.root_dir, bucket)
+        return [os.path.relpath(os.path.join(dir_path, name), bucket_dir).replace(os.sep, '/')
+                for dir_path, _, lst_names in os.walk(bucket_dir) for name in lst_names]
+
+    def describe(self, bucket, key) -> dict:
+        with open(self.get_path(bucket, key), 'rb') as f:
+            body = f.read()
+        return {'Key': key, 'Size': len(body), 'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def write(self, bucket, key, body) -> None:
+        path = self.get_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs) -> dict:
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        self.write(Bucket, Key, body)
+        self.stats.record('s3.put_object', bytes_up=len(body))
+        return {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, **kwargs) -> dict:
+        path = self.get_path(Bucket, Key)
+        if not os.path.isfile(path):
+            self.stats.record('s3.get_object')
+            raise self.exceptions.NoSuchKey(Key)
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.stats.record('s3.get_object', bytes_down=len(body))
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs) -> dict:
+        self.stats.record('s3.head_object')
+        if not os.path.isfile(self.get_path(Bucket, Key)):
+            raise self.exceptions.NoSuchKey(Key)
+        description = self.describe(Bucket, Key)
+        return {'ContentLength': description['Size'], 'ETag': description['ETag']}
+
+    def delete_object(self, Bucket, Key, **kwargs) -> dict:
+        path = self.get_path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        self.stats.record('s3.delete_object')
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs) -> None:
+        path = self.get_path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+        self.stats.record('s3.upload_file', bytes_up=os.path.getsize(path))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None, **kwargs) -> None:
+        body = Fileobj.read()
+        self.write(Bucket, Key, body)
+        self.stats.record('s3.upload_fileobj', bytes_up=len(body))
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs) -> dict:
+        path = self.get_path(CopySource['Bucket'], CopySource['Key'])
+        if not os.path.isfile(path):
+            self.stats.record('s3.copy_object')
+            raise self.exceptions.NoSuchKey(CopySource['Key'])
+        with open(path, 'rb') as f:
+            self.write(Bucket, Key, f.read())
+        self.stats.record('s3.copy_object')
+        return {'CopyObjectResult': {'ETag': self.describe(Bucket, Key)['ETag']}}
+
+    def get_paginator(self, operation_name) -> FakePaginator:
+        return FakePaginator(self)
+
+
+class FakeBoto3:
+    # drop-in for the boto3 module, boto3.resource('s3', ...).meta.client returns the fake client
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def resource(self, service_name='s3', **kwargs):
+        meta = type('Meta', (), {'client': self.s3_client})
+        return type('Resource', (), {'meta': meta})()
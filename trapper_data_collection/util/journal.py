@@ -0,0 +1,79 @@
+import os
+import json
+import threading
+
+
+class RunJournal:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Append-only json-lines journal of the work completed during a run. Every write is flushed and
+               fsynced so the journal survives a crash or a killed runner, and a run that completes clears it.
+               A journal found at start up means the previous run was interrupted and lists what it had done.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.lst_entries = []
+        self.file = None
+
+    def load(self) -> list:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Read the journal left by an interrupted run. A partly written last line is ignored.
+
+            Return: list of journal entries
+        ------------------------------------------------------------------------------------------------------------
+        """
+        self.lst_entries = []
+        if not os.path.exists(self.path):
+            return self.lst_entries
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self.lst_entries.append(json.loads(line))
+                except ValueError:
+                    self.logger.warning('Ignoring a partly written journal entry')
+        if self.lst_entries:
+            self.logger.warning(f'Found a journal with {len(self.lst_entries)} entries from an interrupted run')
+
+        return self.lst_entries
+
+    def append(self, *entries) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Durably record one or more entries
+
+            Parameters:
+                entries: json serialisable dicts, each with an 'op' key
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if not entries:
+            return
+        body = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a')
+            self.file.write(body)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.lst_entries.extend(entries)
+
+    def entries(self, op, layer=None) -> list:
+        with self.lock:
+            return [e for e in self.lst_entries if e['op'] == op and (layer is None or e.get('layer') == layer)]
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.lst_entries = []
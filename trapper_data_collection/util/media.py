@@ -0,0 +1,162 @@
+import os
+import shutil
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+DEFAULT_MAX_DIMENSION = 2048
+DEFAULT_QUALITY = 80
+DEFAULT_THUMBNAIL_SIZE = 320
+IMAGE_TYPES = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG'}
+
+MediaSettings = namedtuple('MediaSettings', ['workers', 'max_dimension', 'quality', 'thumbnail_size',
+                                             'archive_originals'])
+
+
+def process_image(file_path, compressed_path, thumbnail_path, max_dimension, quality, thumbnail_size) -> bool:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Downsize and re-encode a photo and write its thumbnail. Runs in a worker process so it only takes
+                  paths and plain values. EXIF is carried over so the camera timestamp and orientation survive.
+
+        Parameters:
+            file_path: path of the original photo
+            compressed_path: path to write the re-encoded photo to
+            thumbnail_path: path to write the thumbnail to
+            max_dimension: longest side of the re-encoded photo in pixels
+            quality: jpeg quality of the re-encoded photo
+            thumbnail_size: longest side of the thumbnail in pixels
+
+        Return: True if the re-encoded photo is smaller than the original
+    ------------------------------------------------------------------------------------------------------------
+    """
+    from PIL import Image
+
+    image_format = IMAGE_TYPES[file_path.rsplit('.', 1)[-1].lower()]
+    with Image.open(file_path) as image:
+        image.load()
+        dict_save = {'exif': image.info['exif']} if image.info.get('exif') else {}
+        if image_format == 'JPEG':
+            dict_save.update(quality=quality, optimize=True)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+        else:
+            dict_save.update(optimize=True)
+
+        resized = image.copy()
+        resized.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        resized.save(compressed_path, format=image_format, **dict_save)
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+        thumbnail.save(thumbnail_path, format=image_format, **dict_save)
+
+    return os.path.getsize(compressed_path) < os.path.getsize(file_path)
+
+
+class MediaProcessor:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Optional media stage run on photos before they are re-uploaded. Photos are downsized and re-encoded
+               in a process pool, since the work is CPU bound and the transfer threads would otherwise serialise on
+               it. Thumbnails go to object storage for the report, and when configured the original bytes are
+               archived untouched in the photo's report folder, recorded in the report manifest so the reporting
+               job does not replace them with the smaller photo. Videos and other files are passed through as
+               they are.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, settings, logger, s3_client=None, bucket=None, prefix=None, manifest=None):
+        self.settings = settings
+        self.logger = logger
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.manifest = manifest
+        self.archived = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        if settings.archive_originals and s3_client is None:
+            self.logger.warning('Archiving originals needs object storage, photos will not be compressed')
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                # spawn rather than fork, the pool is started from the transfer threads
+                self.pool = ProcessPoolExecutor(max_workers=max(1, self.settings.workers),
+                                                mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def process(self, file_path, folder) -> bool:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Replace a photo with its compressed version in place, archiving the original and uploading
+                      the thumbnail first. The original is kept if compression does not make it smaller.
+
+            Parameters:
+                file_path: path of the photo, already carrying its final name
+                folder: report folder the photo belongs to, e.g. trap_setup
+
+            Return: True if the file was replaced by a smaller one
+        ------------------------------------------------------------------------------------------------------------
+        """
+        file_name = os.path.basename(file_path)
+        if file_name.rsplit('.', 1)[-1].lower() not in IMAGE_TYPES:
+            return False
+        if self.settings.archive_originals and self.s3_client is None:
+            return False
+
+        work_dir = os.path.join(os.path.dirname(file_path), 'media')
+        os.makedirs(work_dir, exist_ok=True)
+        compressed_path = os.path.join(work_dir, file_name)
+        thumbnail_path = os.path.join(work_dir, f'thumbnail_{file_name}')
+        pool = self.get_pool()
+        try:
+            smaller = pool.submit(process_image, file_path, compressed_path, thumbnail_path,
+                                             self.settings.max_dimension, self.settings.quality,
+                                             self.settings.thumbnail_size).result()
+        except BrokenProcessPool as e:
+            # a worker died, e.g. out of memory on a huge photo, start a fresh pool for the next one
+            self.logger.warning(f'Could not compress {file_name}, keeping the original: {e}')
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            pool.shutdown(wait=False)
+            return False
+        except Exception as e:
+            self.logger.warning(f'Could not compress {file_name}, keeping the original: {e}')
+            return False
+
+        if self.s3_client is not None:
+            self.s3_client.upload_file(thumbnail_path, self.bucket, f'{self.prefix}/thumbnails/{folder}/{file_name}')
+        if not smaller:
+            return False
+        if self.settings.archive_originals:
+            key = f'{self.prefix}/{folder}/{file_name}'
+            self.s3_client.upload_file(file_path, self.bucket, key)
+            self.manifest.add(key=key)
+            with self.lock:
+                self.archived += 1
+
+        with self.lock:
+            self.bytes_in += os.path.getsize(file_path)
+            self.bytes_out += os.path.getsize(compressed_path)
+        os.replace(compressed_path, file_path)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return True
+
+    def close(self) -> None:
+        if self.archived:
+            self.manifest.save()
+        if self.bytes_in:
+            self.logger.info(f'Compressed photos from {self.bytes_in / 1024 ** 2:.1f} MB to '
+                             f'{self.bytes_out / 1024 ** 2:.1f} MB')
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
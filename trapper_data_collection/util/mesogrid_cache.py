@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import pandas as pd
+from itertools import chain
+
+from util.queries import iter_query
+
+
+class MesoGridCache:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: On-disk SQLite cache of the meso grid centroids, keyed by the item's last-modified timestamp
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, cache_dir, logger):
+        self.logger = logger
+        self.db_path = os.path.join(cache_dir, 'mesogrid_cache.sqlite')
+        self.dict_centroids = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_info (item_id TEXT PRIMARY KEY, modified INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS centroids '
+                         '(item_id TEXT, mesocell TEXT, centroid_x REAL, centroid_y REAL, '
+                         'PRIMARY KEY (item_id, mesocell))')
+
+    def sync(self, mesogrid_item) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Refresh the cache if the meso grid item has changed since it was last cached and load the
+                      centroids into memory
+
+            Parameters:
+                mesogrid_item: arcgis Item holding the meso grid layer
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        item_id = mesogrid_item.id
+        modified = int(mesogrid_item.modified)
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute('SELECT modified FROM cache_info WHERE item_id = ?', (item_id,)).fetchone()
+            if row is None or row[0] != modified:
+                self.logger.info('Meso grid has changed, refreshing local cache')
+                lst_records = chain.from_iterable(iter_query(ago_flayer=mesogrid_item.layers[0],
+                                                             out_fields='OBJECTID,MesoCell,CENTROID_X,CENTROID_Y'))
+                rows = [(item_id, r['MesoCell'], r['CENTROID_X'], r['CENTROID_Y']) for r in lst_records]
+                conn.execute('DELETE FROM centroids WHERE item_id = ?', (item_id,))
+                conn.executemany('INSERT OR REPLACE INTO centroids VALUES (?, ?, ?, ?)', rows)
+                conn.execute('INSERT OR REPLACE INTO cache_info VALUES (?, ?)', (item_id, modified))
+                self.logger.info(f'Cached {len(rows)} meso grid cell(s)')
+            else:
+                self.logger.debug('Meso grid cache is up to date')
+
+            cursor = conn.execute('SELECT mesocell, centroid_x, centroid_y FROM centroids WHERE item_id = ?',
+                                  (item_id,))
+            self.dict_centroids = {mesocell: (x, y) for mesocell, x, y in cursor}
+
+    def get_centroids(self, grid_ids) -> pd.DataFrame:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Look up the centroids of the given meso grid cells
+
+            Parameters:
+                grid_ids: list of MesoCell ids
+
+            Return: DataFrame with CENTROID_X and CENTROID_Y columns indexed by MesoCell
+        ------------------------------------------------------------------------------------------------------------
+        """
+        found = [g for g in grid_ids if g in self.dict_centroids]
+        missing = len(grid_ids) - len(found)
+        if missing:
+            self.logger.warning(f'{missing} meso grid id(s) were not found in the meso grid layer')
+
+        return pd.DataFrame([self.dict_centroids[g] for g in found], columns=['CENTROID_X', 'CENTROID_Y'],
+                            index=pd.Index(found, name='MesoCell'), dtype=float)
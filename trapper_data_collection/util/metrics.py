@@ -0,0 +1,268 @@
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+PROFILE_TOP_FUNCTIONS = 30
+
+
+class RunMetrics:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Lightweight per-run instrumentation. Stages are timed with the stage context manager, AGOL and S3
+               calls and the bytes they move are counted through request hooks on the GIS session and boto3
+               client events, and each count is attributed to the stage running at the time. The metrics are
+               written as a json document at the end of the run, optionally with a cProfile capture covering the
+               worker threads as well as the main one.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, job, logger, profile=False):
+        self.job = job
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.run_start = datetime.now(timezone.utc)
+        self.start_time = time.perf_counter()
+        self.status = 'failed'
+        self.dict_parameters = {}
+        self.dict_stages = {}
+        self.current_stage = 'setup'
+        self.profiler = None
+        self.lst_thread_profilers = []
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            # a cProfile.Profile only sees the thread that enabled it, so every thread started from here on gets its
+            # own and they are merged when the run finishes. From python 3.12 one profiler sees every thread.
+            if sys.version_info < (3, 12):
+                threading.setprofile(self.start_thread_profiler)
+
+    def start_thread_profiler(self, frame, event, arg) -> None:
+        # installed by threading.setprofile, so called once on the first event of each new thread
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.lst_thread_profilers.append(profiler)
+        profiler.enable()
+
+    def stop_profiling(self) -> 'pstats.Stats':
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Stop the main and per-thread profilers and merge their stats
+
+            Return: pstats Stats
+        ------------------------------------------------------------------------------------------------------------
+        """
+        threading.setprofile(None)
+        self.profiler.disable()
+        with self.lock:
+            lst_profilers = list(self.lst_thread_profilers)
+        stats = pstats.Stats(self.profiler)
+        for profiler in lst_profilers:
+            profiler.disable()
+            stats.add(profiler)
+
+        return stats
+
+    def get_stage(self, name) -> dict:
+        return self.dict_stages.setdefault(name, {'wall_s': 0.0, 'api_calls': Counter(), 'bytes_down': 0,
+                                                  'bytes_up': 0, 'counts': Counter(), 'timers': Counter()})
+
+    @contextmanager
+    def stage(self, name):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Time a stage of the run and attribute the calls made while it runs to it
+
+            Parameters:
+                name: stage name
+
+            Return: context manager
+        ------------------------------------------------------------------------------------------------------------
+        """
+        with self.lock:
+            previous_stage = self.current_stage
+            self.current_stage = name
+            self.get_stage(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            with self.lock:
+                self.dict_stages[name]['wall_s'] += wall
+                self.current_stage = previous_stage
+            self.logger.info(f'{name} finished in {wall:.1f}s')
+
+    @contextmanager
+    def timer(self, name):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Time a piece of work within the current stage, e.g. one layer of a stage that processes its
+                      layers concurrently. Unlike stage it does not change where calls are attributed.
+
+            Parameters:
+                name: timer name
+
+            Return: context manager
+        ------------------------------------------------------------------------------------------------------------
+        """
+        with self.lock:
+            stage_name = self.current_stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.get_stage(stage_name)['timers'][name] += time.perf_counter() - start
+
+    def record_call(self, api_call, bytes_down=0, bytes_up=0) -> None:
+        with self.lock:
+            stage = self.get_stage(self.current_stage)
+            stage['api_calls'][api_call] += 1
+            stage['bytes_down'] += bytes_down
+            stage['bytes_up'] += bytes_up
+
+    def increment(self, name, value=1) -> None:
+        with self.lock:
+            self.get_stage(self.current_stage)['counts'][name] += value
+
+    def watch_gis(self, gis) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Count every request made through the GIS connection's HTTP session
+
+            Parameters:
+                gis: arcgis GIS object
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        session = getattr(getattr(gis, '_con', None), '_session', None)
+        hooks = getattr(session, 'hooks', None)
+        if hooks is None:
+            self.logger.warning('GIS session does not support request hooks, AGOL calls will not be counted')
+            return
+
+        def on_response(response, *args, **kwargs):
+            lst_path = [part for part in urlparse(response.url).path.split('/') if part]
+            endpoint = lst_path[-1] if lst_path else ''
+            if endpoint.isdigit():
+                endpoint = 'attachment' if len(lst_path) > 1 and lst_path[-2] == 'attachments' else 'layer'
+            if kwargs.get('stream'):
+                # reading a streamed body here would buffer it, so rely on the header
+                bytes_down = int(response.headers.get('Content-Length') or 0)
+            else:
+                bytes_down = len(response.content or b'')
+            body = getattr(response.request, 'body', None)
+            bytes_up = len(body) if isinstance(body, (bytes, str)) else 0
+            self.record_call(f'agol.{endpoint}', bytes_down=bytes_down, bytes_up=bytes_up)
+            return response
+
+        hooks.setdefault('response', []).append(on_response)
+
+    def watch_s3(self, s3_client) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Count every call made through a boto3 S3 client
+
+            Parameters:
+                s3_client: boto3 S3 client
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        events = getattr(getattr(s3_client, 'meta', None), 'events', None)
+        if events is None:
+            self.logger.debug('S3 client does not support events, object storage calls will not be counted')
+            return
+
+        def on_before_send(request, **kwargs):
+            # chunked uploads with checksums carry the payload size in the decoded length header
+            content_length = request.headers.get('X-Amz-Decoded-Content-Length') or request.headers.get('Content-Length')
+            if getattr(request, 'context', None) is not None and content_length:
+                request.context['metrics_bytes_up'] = int(content_length)
+
+        def on_after_call(http_response, model, context, **kwargs):
+            bytes_down = int(http_response.headers.get('Content-Length') or 0) if model.name == 'GetObject' else 0
+            self.record_call(f's3.{model.name}', bytes_down=bytes_down,
+                             bytes_up=context.get('metrics_bytes_up', 0))
+
+        events.register('before-send.s3', on_before_send)
+        events.register('after-call.s3', on_after_call)
+
+    def set_parameters(self, **kwargs) -> None:
+        self.dict_parameters.update(kwargs)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            dict_stages = {name: {'wall_s': round(stage['wall_s'], 3), 'api_calls': dict(stage['api_calls']),
+                                  'api_call_count': sum(stage['api_calls'].values()),
+                                  'bytes_down': stage['bytes_down'], 'bytes_up': stage['bytes_up'],
+                                  'counts': dict(stage['counts']),
+                                  'timers': {k: round(v, 3) for k, v in stage['timers'].items()}}
+                           for name, stage in self.dict_stages.items()}
+
+        return {'job': self.job, 'status': self.status, 'run_start': self.run_start.isoformat(),
+                'wall_s': round(time.perf_counter() - self.start_time, 3), 'parameters': self.dict_parameters,
+                'api_call_count': sum(s['api_call_count'] for s in dict_stages.values()),
+                'bytes_down': sum(s['bytes_down'] for s in dict_stages.values()),
+                'bytes_up': sum(s['bytes_up'] for s in dict_stages.values()),
+                'stages': dict_stages}
+
+    def finish(self, metrics_dir, s3_client=None, bucket=None, prefix=None) -> str:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Stop profiling, write the metrics json (and profile) for the run and upload them to the bucket
+                      when a client is given. Errors are logged rather than raised so they never fail the run.
+
+            Parameters:
+                metrics_dir: local directory the files are written to
+                s3_client: optional boto3 S3 client used to upload the files
+                bucket: bucket the files are uploaded to
+                prefix: key prefix the files are uploaded under
+
+            Return: path of the metrics json
+        ------------------------------------------------------------------------------------------------------------
+        """
+        timestamp = self.run_start.strftime('%Y-%m-%d_%H-%M-%S')
+        lst_files = []
+        dict_metrics = self.to_dict()
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            if self.profiler is not None:
+                stats = self.stop_profiling()
+                profile_file = os.path.join(metrics_dir, f'{timestamp}_{self.job}.prof')
+                stats.dump_stats(profile_file)
+                lst_files.append(profile_file)
+                stream = io.StringIO()
+                stats.stream = stream
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+                dict_metrics['profile_top'] = stream.getvalue().splitlines()
+
+            metrics_file = os.path.join(metrics_dir, f'{timestamp}_{self.job}_metrics.json')
+            with open(metrics_file, 'w') as f:
+                json.dump(dict_metrics, f, indent=2)
+            lst_files.insert(0, metrics_file)
+            self.logger.info(f'Run metrics: {dict_metrics["wall_s"]:.1f}s, {dict_metrics["api_call_count"]} API '
+                             f'call(s), written to {metrics_file}')
+        except Exception as e:
+            self.logger.warning(f'Could not write run metrics: {e}')
+            return None
+
+        if s3_client is not None:
+            for file_path in lst_files:
+                try:
+                    s3_client.upload_file(file_path, bucket, f'{prefix}/{self.job}/{os.path.basename(file_path)}')
+                except Exception as e:
+                    self.logger.warning(f'Could not upload {os.path.basename(file_path)} to object storage: {e}')
+
+        return metrics_file
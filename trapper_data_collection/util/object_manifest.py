@@ -0,0 +1,88 @@
+import json
+import threading
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class ObjectManifest:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Manifest of the files copied to object storage (key, size and ETag), kept as a json object in the
+               bucket and updated incrementally after each upload
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, s3_client, bucket, prefix, logger):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.logger = logger
+        self.manifest_key = f'{prefix}/{MANIFEST_NAME}'
+        self.dict_objects = {}
+        self.lock = threading.Lock()
+
+    def load(self, folders) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Load the manifest from the bucket, rebuilding it from prefix-scoped listings of the given
+                      folders if it does not exist yet
+
+            Parameters:
+                folders: list of folders under the prefix that hold copied files
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.manifest_key)
+            self.dict_objects = json.loads(response['Body'].read())
+            self.logger.info(f'Loaded object storage manifest with {len(self.dict_objects)} file(s)')
+            return
+        except self.s3_client.exceptions.NoSuchKey:
+            self.logger.info('No object storage manifest found, building one from the bucket listing')
+
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for folder in folders:
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{self.prefix}/{folder}/'):
+                for obj in page.get('Contents', []):
+                    self.dict_objects[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag']}
+        self.save()
+
+    def contains(self, key) -> bool:
+        return key in self.dict_objects
+
+    def add(self, key) -> dict:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Record a file that has just been uploaded
+
+            Parameters:
+                key: object key of the uploaded file
+
+            Return: dict of the file's size and etag
+        ------------------------------------------------------------------------------------------------------------
+        """
+        response = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        entry = {'size': response['ContentLength'], 'etag': response['ETag']}
+        with self.lock:
+            self.dict_objects[key] = entry
+
+        return entry
+
+    def restore(self, dict_entries) -> None:
+        # files recorded by an interrupted run, e.g. from its journal
+        with self.lock:
+            self.dict_objects.update(dict_entries)
+
+    def save(self) -> None:
+        # held over the upload so saves from layers running at once cannot land out of order. Files recorded in the
+        # bucket copy since it was loaded, e.g. originals archived by the modification job, are merged in first.
+        with self.lock:
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.manifest_key)
+                self.dict_objects = {**json.loads(response['Body'].read()), **self.dict_objects}
+            except self.s3_client.exceptions.NoSuchKey:
+                pass
+            body = json.dumps(self.dict_objects)
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.manifest_key, Body=body.encode('utf-8'),
+                                      ContentType='application/json')
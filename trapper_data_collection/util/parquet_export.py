@@ -0,0 +1,77 @@
+import io
+import json
+import hashlib
+
+PARQUET_COMPRESSION = 'zstd'
+
+
+class ParquetExporter:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Writes layer snapshots to object storage as compressed Parquet, partitioned by month. A content
+               hash is kept for every partition so only partitions whose rows changed are rewritten.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, s3_client, bucket, prefix, logger):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = f'{prefix}/parquet'
+        self.logger = logger
+        self.hashes_key = f'{self.prefix}/partition_hashes.json'
+        self.dict_hashes = {}
+
+    def load(self) -> None:
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.hashes_key)
+            self.dict_hashes = json.loads(response['Body'].read())
+        except self.s3_client.exceptions.NoSuchKey:
+            self.dict_hashes = {}
+
+    def save(self) -> None:
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.hashes_key,
+                                  Body=json.dumps(self.dict_hashes, indent=2).encode('utf-8'),
+                                  ContentType='application/json')
+
+    def export_layer(self, layer_name, df, date_field) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Write a layer to <prefix>/parquet/<layer>/month=YYYY-MM/part-0.parquet, skipping partitions
+                      whose content has not changed and removing partitions that no longer have any rows
+
+            Parameters:
+                layer_name: folder name for the layer
+                df: pandas DataFrame of the layer, geometry in a SHAPE column of esri json dicts if present
+                date_field: date field used to partition the rows by month
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        import pandas as pd
+
+        df = df.copy()
+        if 'SHAPE' in df.columns:
+            df['SHAPE'] = df['SHAPE'].map(lambda geom: json.dumps(geom) if geom else None)
+        months = pd.to_datetime(df[date_field]).dt.strftime('%Y-%m').fillna('unknown')
+
+        layer_prefix = f'{self.prefix}/{layer_name}/'
+        set_current = set()
+        written = 0
+        for month, df_part in df.groupby(months, sort=True):
+            key = f'{layer_prefix}month={month}/part-0.parquet'
+            set_current.add(key)
+            df_part = df_part.sort_values('OBJECTID').reset_index(drop=True)
+            part_hash = hashlib.sha256(pd.util.hash_pandas_object(df_part, index=False).values.tobytes()).hexdigest()
+            if self.dict_hashes.get(key) == part_hash:
+                continue
+            buffer = io.BytesIO()
+            df_part.to_parquet(buffer, compression=PARQUET_COMPRESSION, index=False)
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=buffer.getvalue())
+            self.dict_hashes[key] = part_hash
+            written += 1
+
+        for key in [k for k in self.dict_hashes if k.startswith(layer_prefix) and k not in set_current]:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+            del self.dict_hashes[key]
+
+        self.logger.info(f'Wrote {written} of {len(set_current)} {layer_name} partition(s) to parquet')
@@ -0,0 +1,62 @@
+import json
+from collections import namedtuple
+
+# bucket prefix of the original project, new projects get their own folder under it unless they set one
+DEFAULT_PREFIX = 'trapper_data_collection'
+
+ProjectConfig = namedtuple('ProjectConfig', ['name', 'maphub', 'traps', 'meso_grid', 'fisher', 'bucket', 'prefix'])
+
+
+def project_from_config(config) -> ProjectConfig:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Build the project the scripts run against by default from the trap_config module
+
+        Parameters:
+            config: trap_config module
+
+        Return: ProjectConfig
+    ------------------------------------------------------------------------------------------------------------
+    """
+    return ProjectConfig(name='default', maphub=config.MAPHUB, traps=config.TRAPS, meso_grid=config.MESO_GRID,
+                         fisher=config.FISHER, bucket=config.BUCKET, prefix=DEFAULT_PREFIX)
+
+
+def load_projects(path, default_project) -> list:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Read a json list of project configs. Each needs a name and the traps, meso_grid and fisher item
+                  ids. maphub and bucket default to those of the default project and prefix defaults to a folder
+                  named after the project.
+
+        Parameters:
+            path: path to the json file
+            default_project: ProjectConfig supplying the defaults
+
+        Return: list of ProjectConfig
+    ------------------------------------------------------------------------------------------------------------
+    """
+    with open(path) as f:
+        lst_configs = json.load(f)
+
+    lst_projects = []
+    for config in lst_configs:
+        missing = [k for k in ['name', 'traps', 'meso_grid', 'fisher'] if not config.get(k)]
+        if missing:
+            raise ValueError(f'Project config {config.get("name", "")} is missing {", ".join(missing)}')
+        unknown = set(config) - set(ProjectConfig._fields)
+        if unknown:
+            raise ValueError(f'Project config {config["name"]} has unknown keys {", ".join(sorted(unknown))}')
+        lst_projects.append(ProjectConfig(name=config['name'], maphub=config.get('maphub', default_project.maphub),
+                                          traps=config['traps'], meso_grid=config['meso_grid'],
+                                          fisher=config['fisher'], bucket=config.get('bucket', default_project.bucket),
+                                          prefix=config.get('prefix', f'{DEFAULT_PREFIX}/{config["name"]}')))
+
+    lst_names = [p.name for p in lst_projects]
+    if len(set(lst_names)) != len(lst_names):
+        raise ValueError('Project names must be unique')
+    set_locations = {(p.bucket, p.prefix) for p in lst_projects}
+    if len(set_locations) != len(lst_projects):
+        raise ValueError('Projects must not share a bucket prefix')
+
+    return lst_projects
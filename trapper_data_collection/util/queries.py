@@ -0,0 +1,112 @@
+from itertools import chain
+
+IN_CHUNK_SIZE = 200
+DEFAULT_PAGE_SIZE = 1000
+
+
+def build_in_clauses(field, values, chunk_size=IN_CHUNK_SIZE) -> list:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Build where clauses selecting the given values, split into chunks so no single clause exceeds
+                  URL/SQL length limits
+
+        Parameters:
+            field: field name to filter on
+            values: list of string values
+            chunk_size: number of values per clause
+
+        Return: list of sql where clauses
+    ------------------------------------------------------------------------------------------------------------
+    """
+    lst_values = sorted(set(values))
+    lst_clauses = []
+    for i in range(0, len(lst_values), chunk_size):
+        lst_escaped = [str(v).replace("'", "''") for v in lst_values[i:i + chunk_size]]
+        str_list = ','.join([f'\'{v}\'' for v in lst_escaped])
+        lst_clauses.append(f'{field} IN ({str_list})')
+
+    return lst_clauses
+
+
+def iter_query(ago_flayer, where='1=1', out_fields='*', return_geometry=False, page_size=None):
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Page through a query with resultOffset/resultRecordCount, yielding one page of compact records
+                  at a time so the whole result never has to be held as a FeatureSet. Memory only stays flat when
+                  the caller consumes the pages as they come, query_records and the run snapshot keep them all.
+
+        Parameters:
+            ago_flayer: arcgis FeatureLayer or Table
+            where: sql where clause
+            out_fields: comma separated list of fields to return
+            return_geometry: whether geometry is returned, stored under the SHAPE key of each record
+            page_size: records per request, defaults to the layer's maxRecordCount
+
+        Return: generator of lists of attribute dicts
+    ------------------------------------------------------------------------------------------------------------
+    """
+    if page_size is None:
+        page_size = ago_flayer.properties.get('maxRecordCount') or DEFAULT_PAGE_SIZE
+
+    offset = 0
+    while True:
+        fset = ago_flayer.query(where=where, out_fields=out_fields, return_geometry=return_geometry,
+                                order_by_fields='OBJECTID ASC', result_offset=offset,
+                                result_record_count=page_size, return_all_records=False)
+        lst_records = []
+        for f in fset.features:
+            record = dict(f.attributes)
+            if return_geometry:
+                record['SHAPE'] = f.geometry
+            lst_records.append(record)
+        if lst_records:
+            yield lst_records
+        if len(lst_records) < page_size:
+            return
+        offset += len(lst_records)
+
+
+def query_records(ago_flayer, lst_where, out_fields='*', return_geometry=False) -> list:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Run a paged query for each where clause and combine the records. The combined records are held
+                  in memory, so this grows with the size of the result.
+
+        Parameters:
+            ago_flayer: arcgis FeatureLayer or Table
+            lst_where: list of sql where clauses
+            out_fields: comma separated list of fields to return
+            return_geometry: whether geometry is returned
+
+        Return: list of attribute dicts, de-duplicated on OBJECTID
+    ------------------------------------------------------------------------------------------------------------
+    """
+    dict_records = {}
+    for where in lst_where:
+        for record in chain.from_iterable(iter_query(ago_flayer=ago_flayer, where=where, out_fields=out_fields,
+                                                     return_geometry=return_geometry)):
+            dict_records[record['OBJECTID']] = record
+
+    return list(dict_records.values())
+
+
+def records_to_frame(lst_records, ago_flayer) -> 'pd.DataFrame':
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Convert query records to a DataFrame, turning date fields from epoch milliseconds into datetimes
+
+        Parameters:
+            lst_records: list of attribute dicts
+            ago_flayer: arcgis FeatureLayer or Table the records came from
+
+        Return: pandas DataFrame
+    ------------------------------------------------------------------------------------------------------------
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(lst_records)
+    for field in ago_flayer.properties.fields:
+        if field['type'] == 'esriFieldTypeDate' and field['name'] in df.columns:
+            df[field['name']] = pd.to_datetime(df[field['name']], unit='ms')
+
+    return df
@@ -0,0 +1,77 @@
+import xlsxwriter
+
+MIN_COL_WIDTH = 8
+MAX_COL_WIDTH = 60
+
+
+def get_col_widths(dataframe, index=True) -> list:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Work out column widths from the longest value (or header) in each column
+
+        Parameters:
+            dataframe: pandas DataFrame
+            index: whether the first width is for the index column
+
+        Return: list of widths, left to right
+    ------------------------------------------------------------------------------------------------------------
+    """
+    lst_widths = []
+    if index:
+        # First we find the maximum length of the index column
+        idx_max = dataframe.index.astype(str).str.len().max() if len(dataframe) else 0
+        lst_widths.append(max(idx_max, len(str(dataframe.index.name))))
+
+    # Then, we concatenate this to the max of the lengths of column name and its values for each column, left to right
+    if len(dataframe):
+        value_max = dataframe.astype(str).apply(lambda col: col.str.len().max())
+    else:
+        value_max = {col: 0 for col in dataframe.columns}
+
+    return lst_widths + [max(int(value_max[col]), len(str(col))) + 4 for col in dataframe.columns]
+
+
+class ReportWriter:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Writes DataFrames to an Excel workbook row by row in constant memory. Wrap and width are applied as
+               column formats rather than per cell.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, xl_report, logger):
+        self.logger = logger
+        self.workbook = xlsxwriter.Workbook(xl_report, {'constant_memory': True,
+                                                        'default_date_format': 'yyyy-mm-dd',
+                                                        'strings_to_formulas': False,
+                                                        'strings_to_urls': False})
+        self.header_format = self.workbook.add_format({'bold': True, 'border': 1, 'text_wrap': True,
+                                                       'align': 'center', 'valign': 'top'})
+        self.wrap_format = self.workbook.add_format({'text_wrap': True, 'valign': 'top'})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.workbook.close()
+
+    def add_sheet(self, sheet_name, df) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Write a DataFrame to a new worksheet with a header row, wrapped text and auto column widths
+
+            Parameters:
+                sheet_name: name of the worksheet
+                df: pandas DataFrame, written without its index
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        ws = self.workbook.add_worksheet(sheet_name)
+        for col, width in enumerate(get_col_widths(df, index=False)):
+            ws.set_column(col, col, min(max(width, MIN_COL_WIDTH), MAX_COL_WIDTH), self.wrap_format)
+
+        ws.write_row(0, 0, [str(col) for col in df.columns], self.header_format)
+        df_values = df.astype(object).where(df.notna(), None)
+        for row, values in enumerate(df_values.itertuples(index=False, name=None), start=1):
+            ws.write_row(row, 0, values)
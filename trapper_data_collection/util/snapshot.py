@@ -0,0 +1,101 @@
+import threading
+
+from util.queries import query_records
+
+
+class SnapshotCache:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Run-scoped cache of items and layer query results so every stage of a run shares one download of
+               each layer. Edits a stage sends to AGOL are applied to the cached features instead of refetching.
+               The trade-off is memory: each snapshot holds its whole result for the rest of the run, so peak
+               memory grows with layer size even though the layer is downloaded a page at a time.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, gis, logger):
+        self.gis = gis
+        self.logger = logger
+        self.dict_items = {}
+        self.dict_snapshots = {}
+        self.dict_key_locks = {}
+        self.lock = threading.RLock()
+
+    def get_item(self, item_id):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Get an arcgis item, only calling gis.content.get the first time it is requested in the run
+
+            Parameters:
+                item_id: AGOL item id
+
+            Return: arcgis Item
+        ------------------------------------------------------------------------------------------------------------
+        """
+        with self.lock:
+            if item_id not in self.dict_items:
+                self.dict_items[item_id] = self.gis.content.get(item_id)
+            return self.dict_items[item_id]
+
+    def query(self, ago_flayer, where='1=1', out_fields='*', return_geometry=False):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Query a layer, serving the result from an earlier snapshot of the same layer and where clause
+                      when that snapshot already holds the requested fields and geometry
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table
+                where: sql where clause
+                out_fields: comma separated list of fields to return
+                return_geometry: whether geometry is returned
+
+            Return: list of attribute dicts, with geometry under the SHAPE key when requested
+        ------------------------------------------------------------------------------------------------------------
+        """
+        set_fields = None if out_fields == '*' else {f.strip() for f in out_fields.split(',')}
+        key = (ago_flayer.url, where)
+        with self.lock:
+            key_lock = self.dict_key_locks.setdefault(key, threading.Lock())
+
+        # only requests for the same layer and where clause wait on each other, other layers download in parallel
+        with key_lock:
+            with self.lock:
+                for set_cached_fields, cached_geometry, lst_records in self.dict_snapshots.get(key, []):
+                    if (set_cached_fields is None or (set_fields is not None and set_fields <= set_cached_fields)) \
+                            and (cached_geometry or not return_geometry):
+                        self.logger.debug(f'Serving {ago_flayer.url} ({where}) from the run snapshot')
+                        return lst_records
+
+            lst_records = query_records(ago_flayer=ago_flayer, lst_where=[where], out_fields=out_fields,
+                                        return_geometry=return_geometry)
+            with self.lock:
+                self.dict_snapshots.setdefault(key, []).append((set_fields, return_geometry, lst_records))
+            return lst_records
+
+    def apply_edits(self, ago_flayer, updates) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Apply features sent to edit_features to every cached snapshot of the layer
+
+            Parameters:
+                ago_flayer: arcgis FeatureLayer or Table the edits were sent to
+                updates: feature dicts sent to edit_features, matched to the cached records on OBJECTID
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        dict_updates = {u['attributes']['OBJECTID']: u for u in updates}
+        with self.lock:
+            for (url, where), lst_snapshots in self.dict_snapshots.items():
+                if url != ago_flayer.url:
+                    continue
+                for set_cached_fields, cached_geometry, lst_records in lst_snapshots:
+                    for record in lst_records:
+                        update = dict_updates.get(record['OBJECTID'])
+                        if update is None:
+                            continue
+                        for field, value in update['attributes'].items():
+                            if set_cached_fields is None or field in set_cached_fields:
+                                record[field] = value
+                        if cached_geometry and update.get('geometry'):
+                            record['SHAPE'] = update['geometry']
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+
+# tokens this close to expiring are not reused, a run must be able to finish on the token it starts with
+TOKEN_EXPIRY_MARGIN_MS = 2 * 60 * 60 * 1000
+
+
+class TokenCache:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: File cache of AGOL tokens so a run can reuse a still-valid token instead of logging in again.
+               Tokens are kept per portal and user, encrypted with a key derived from the user's password, so the
+               file is no use to anyone who can read the cache but does not hold the password. The file is only
+               readable by its owner and is replaced atomically, so several processes can share it.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    def get_key(self, url, username) -> str:
+        return f'{url}|{username}'
+
+    def get_fernet(self, secret):
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            self.logger.debug('cryptography is not installed, AGOL tokens will not be cached')
+            return None
+        key = hashlib.pbkdf2_hmac('sha256', secret.encode('utf-8'), b'trapper-token-cache', 100000)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def write(self, dict_tokens) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(dict_tokens, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, url, username, secret):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Get a cached token that is not close to expiring
+
+            Parameters:
+                url: portal url
+                username: AGOL username
+                secret: AGOL password, used to decrypt the token
+
+            Return: token, None if there is no usable token
+        ------------------------------------------------------------------------------------------------------------
+        """
+        fernet = self.get_fernet(secret)
+        if fernet is None:
+            return None
+        with self.lock:
+            entry = self.read().get(self.get_key(url, username))
+        if entry is None or entry['expires'] - TOKEN_EXPIRY_MARGIN_MS < time.time() * 1000:
+            return None
+        try:
+            return fernet.decrypt(entry['token'].encode('utf-8')).decode('utf-8')
+        except Exception:
+            self.logger.debug('Cached AGOL token could not be decrypted')
+            return None
+
+    def put(self, url, username, secret, token, expires) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Cache a token, dropping any expired ones
+
+            Parameters:
+                url: portal url
+                username: AGOL username
+                secret: AGOL password, used to encrypt the token
+                token: AGOL token
+                expires: expiry time of the token in epoch milliseconds
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        fernet = self.get_fernet(secret)
+        if fernet is None or not token:
+            return
+        now = time.time() * 1000
+        with self.lock:
+            dict_tokens = {k: e for k, e in self.read().items() if e['expires'] > now}
+            dict_tokens[self.get_key(url, username)] = {'token': fernet.encrypt(token.encode('utf-8')).decode('utf-8'),
+                                                        'expires': expires}
+            self.write(dict_tokens)
+
+    def invalidate(self, url, username) -> None:
+        with self.lock:
+            dict_tokens = self.read()
+            if dict_tokens.pop(self.get_key(url, username), None) is not None:
+                self.write(dict_tokens)
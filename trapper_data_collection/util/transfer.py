@@ -0,0 +1,136 @@
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_WORKERS = 4
+
+# the traps, trap checks and fisher layers
+DEFAULT_LAYER_WORKERS = 3
+
+TransferResult = namedtuple('TransferResult', ['task', 'result', 'error'])
+
+
+class RetryPolicy:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Retries a call with exponential backoff
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, retries=3, backoff=2.0, should_retry=None):
+        self.logger = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.should_retry = should_retry
+
+    def call(self, func, *args, **kwargs):
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Call a function, retrying it with exponential backoff if it raises
+
+            Parameters:
+                func: function to call
+                args, kwargs: arguments passed to the function
+
+            Return: the function's return value, the last exception is raised once the retries are used up or
+                    when should_retry rejects it
+        ------------------------------------------------------------------------------------------------------------
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or (self.should_retry is not None and not self.should_retry(e)):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning(f'{getattr(func, "__name__", "call")} failed ({e}), retrying in {delay:.0f}s')
+                time.sleep(delay)
+
+
+class TransferPool:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Runs attachment transfers on a bounded pool of worker threads, isolating failures per item
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, workers=DEFAULT_WORKERS, retry_policy=None, limiter=None):
+        self.logger = logger
+        self.workers = max(1, workers)
+        self.retry_policy = retry_policy or RetryPolicy(logger=logger)
+        self.limiter = limiter
+
+    def run(self, func, tasks, label='transfer') -> list:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Run a function over every task concurrently. An exception in one task is logged and recorded
+                      in its result without stopping the others.
+
+            Parameters:
+                func: function taking a single task
+                tasks: list of tasks
+                label: name used in log messages
+
+            Return: list of TransferResult in the same order as tasks
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if not tasks:
+            return []
+
+        lst_results = [None] * len(tasks)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            dict_futures = {executor.submit(self.run_limited, func, task): i for i, task in enumerate(tasks)}
+            for future in as_completed(dict_futures):
+                i = dict_futures[future]
+                try:
+                    lst_results[i] = TransferResult(task=tasks[i], result=future.result(), error=None)
+                except Exception as e:
+                    self.logger.error(f'{label} failed for {tasks[i]}: {e}')
+                    lst_results[i] = TransferResult(task=tasks[i], result=None, error=e)
+
+        failed = sum(1 for r in lst_results if r.error is not None)
+        if failed:
+            self.logger.warning(f'{failed} of {len(tasks)} {label}(s) failed')
+
+        return lst_results
+
+    def run_limited(self, func, task):
+        # the limiter caps transfers across every pool sharing it, e.g. when several layers run at once
+        with self.limiter or nullcontext():
+            return func(task)
+
+
+def run_concurrently(jobs, logger, workers=DEFAULT_LAYER_WORKERS, label='layer') -> list:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        FUNCTION: Run independent jobs on a thread pool, or in sequence when workers is 1. Every job is allowed to
+                  finish before the first error is raised, so one failing layer does not cut the others short.
+
+        Parameters:
+            jobs: list of functions taking no arguments
+            logger: logger
+            workers: number of jobs run at once
+            label: name used in log messages
+
+        Return: list of job return values in the same order as jobs
+    ------------------------------------------------------------------------------------------------------------
+    """
+    if workers <= 1:
+        return [job() for job in jobs]
+
+    lst_results = [None] * len(jobs)
+    lst_errors = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        dict_futures = {executor.submit(job): i for i, job in enumerate(jobs)}
+        for future in as_completed(dict_futures):
+            try:
+                lst_results[dict_futures[future]] = future.result()
+            except Exception as e:
+                logger.error(f'{label} job failed: {e}')
+                lst_errors.append(e)
+
+    if lst_errors:
+        raise lst_errors[0]
+
+    return lst_results
@@ -0,0 +1,183 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+# rewind applied to the run start time when advancing a watermark, covers clock skew between the runner and AGOL
+WATERMARK_MARGIN = timedelta(minutes=10)
+
+
+class WatermarkState:
+    """
+    ------------------------------------------------------------------------------------------------------------
+        CLASS: Per-layer EDIT_DATE/OBJECTID high-water marks used to only query features edited since the last
+               successful run, along with each layer's feature count so deletions can be noticed too. The state is a
+               small json document kept in a local file or in the bucket.
+    ------------------------------------------------------------------------------------------------------------
+    """
+
+    def __init__(self, logger, full=False, state_path=None, s3_client=None, bucket=None, key=None):
+        self.logger = logger
+        self.full = full
+        self.state_path = state_path
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+        self.run_start = datetime.now(timezone.utc)
+        self.dict_state = {}
+        self.dict_max_oids = {}
+        self.dict_counts = {}
+        self.set_held = set()
+        self.lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Load the watermarks saved by the last successful run
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if self.full:
+            self.logger.info('Full rebuild requested, ignoring saved watermarks')
+            return
+        if self.s3_client is not None:
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+                self.dict_state = json.loads(response['Body'].read())
+            except self.s3_client.exceptions.NoSuchKey:
+                self.dict_state = {}
+        elif self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.dict_state = json.load(f)
+        if not self.dict_state:
+            self.logger.info('No saved watermarks found, processing all features')
+
+    def where(self, layer_key, fld_edit_date='EDIT_DATE') -> str:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Build the where clause selecting features edited since the layer's watermark. Features without
+                      an edit date are picked up by OBJECTID instead.
+
+            Parameters:
+                layer_key: name the watermark is stored under
+                fld_edit_date: edit date field of the layer
+
+            Return: sql where clause
+        ------------------------------------------------------------------------------------------------------------
+        """
+        self.dict_max_oids.setdefault(layer_key, 0)
+        mark = self.dict_state.get(layer_key)
+        if self.full or not mark:
+            return '1=1'
+        edit_date = datetime.fromtimestamp(mark['edit_date'] / 1000, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+        return f'({fld_edit_date} >= TIMESTAMP \'{edit_date}\' OR ' \
+               f'({fld_edit_date} IS NULL AND OBJECTID > {mark["objectid"]}))'
+
+    def has_changes(self, lst_layers, logger) -> bool:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Check whether any layer has been edited or had features deleted since the last successful run,
+                      using count only queries so nothing is downloaded. Deleting a feature leaves no edit date
+                      behind, so each layer's total count is compared with the one saved by the last run as well.
+                      Every layer is counted so all of their counts are saved at the end of the run.
+
+            Parameters:
+                lst_layers: list of (layer_key, arcgis FeatureLayer or Table)
+                logger: logger object
+
+            Return: True if any layer changed
+        ------------------------------------------------------------------------------------------------------------
+        """
+        changed = False
+        for layer_key, ago_flayer in lst_layers:
+            edit_count = ago_flayer.query(where=self.where(layer_key), return_count_only=True)
+            logger.info(f'{edit_count} {layer_key} edited since the last run')
+            total_count = ago_flayer.query(where='1=1', return_count_only=True)
+            if self.count_changed(layer_key, total_count):
+                logger.info(f'{layer_key} feature count changed since the last run, now {total_count}')
+                changed = True
+            changed = changed or bool(edit_count)
+
+        return changed
+
+    def count_changed(self, layer_key, count) -> bool:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Record a layer's total feature count to be saved with its watermark and compare it with the
+                      count saved by the last run
+
+            Parameters:
+                layer_key: name the watermark is stored under
+                count: number of features in the layer
+
+            Return: True if the count differs or there is no saved count to compare with
+        ------------------------------------------------------------------------------------------------------------
+        """
+        with self.lock:
+            self.dict_counts[layer_key] = count
+        mark = self.dict_state.get(layer_key)
+
+        return self.full or not mark or mark.get('count') != count
+
+    def observe(self, layer_key, lst_oids) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Record the OBJECTIDs processed for a layer so the OBJECTID mark can be advanced
+
+            Parameters:
+                layer_key: name the watermark is stored under
+                lst_oids: OBJECTIDs that were processed
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        if lst_oids:
+            with self.lock:
+                self.dict_max_oids[layer_key] = max(self.dict_max_oids.get(layer_key, 0), max(lst_oids))
+
+    def hold(self, layer_key) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Keep a layer's watermark where it is so features that failed are retried on the next run
+
+            Parameters:
+                layer_key: name the watermark is stored under
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        self.logger.warning(f'Not advancing the {layer_key} watermark, failed features will be retried next run')
+        with self.lock:
+            self.set_held.add(layer_key)
+
+    def save(self) -> None:
+        """
+        ------------------------------------------------------------------------------------------------------------
+            FUNCTION: Advance the watermark of every layer queried during the run and save the state. Only call
+                      this once the run has completed successfully.
+
+            Return: None
+        ------------------------------------------------------------------------------------------------------------
+        """
+        edit_date = int((self.run_start - WATERMARK_MARGIN).timestamp() * 1000)
+        for layer_key, max_oid in self.dict_max_oids.items():
+            if layer_key in self.set_held:
+                continue
+            previous = self.dict_state.get(layer_key, {})
+            self.dict_state[layer_key] = {'edit_date': edit_date, 'objectid': max(previous.get('objectid', 0), max_oid)}
+            count = self.dict_counts.get(layer_key, previous.get('count'))
+            if count is not None:
+                self.dict_state[layer_key]['count'] = count
+
+        body = json.dumps(self.dict_state, indent=2)
+        if self.s3_client is not None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body.encode('utf-8'),
+                                      ContentType='application/json')
+        elif self.state_path:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, 'w') as f:
+                f.write(body)
+        self.logger.info('Saved watermarks')